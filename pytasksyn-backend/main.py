@@ -1,7 +1,7 @@
 #!/usr/bin/env python3
 import argparse
 from fastapi import FastAPI, HTTPException
-from fastapi.responses import StreamingResponse, JSONResponse
+from fastapi.responses import StreamingResponse, JSONResponse, ORJSONResponse
 from pydantic import BaseModel
 import os
 import sys
@@ -12,13 +12,21 @@ from dotenv import load_dotenv
 from pathlib import Path
 import httpx
 import re
+from urllib.parse import urlsplit, parse_qs
 from typing import Optional, Union
 import asyncio
 import json
+import orjson
 import uuid
 import shutil
 import subprocess
 import hashlib
+import io
+import random
+import tarfile
+import time
+from functools import lru_cache
+from contextlib import asynccontextmanager
 
 # Load .env from root folder
 root_dir = Path(__file__).parent.parent
@@ -28,11 +36,47 @@ load_dotenv(env_path)
 # Add root directory to path for pytasksyn imports
 sys.path.insert(0, str(root_dir))
 
-# Import pytasksyn modules
-from pytasksyn.main import load_config, run_pipeline, create_llm
+# Import pytasksyn modules. pytasksyn.main drags in the whole langchain
+# stack, so it is imported lazily at the call sites (run_pipeline in the
+# SSE producer, create_llm in evaluate_review); logging_utils is
+# stdlib-only and fine to load eagerly.
 from pytasksyn.utils.logging_utils import init_logger, get_logger
 
-app = FastAPI()
+# Single shared HTTP client for all GitHub traffic: one connection pool,
+# keepalive reuse, no per-request TCP+TLS handshake
+GITHUB_CLIENT: Optional[httpx.AsyncClient] = None
+
+def _github_headers() -> dict:
+    github_token = os.getenv("GITHUB_TOKEN")
+    if github_token:
+        return {"Authorization": f"token {github_token}"}
+    return {}
+
+def _github_client() -> httpx.AsyncClient:
+    global GITHUB_CLIENT
+    if GITHUB_CLIENT is None:
+        # Lazily created outside the lifespan (e.g. direct function calls)
+        GITHUB_CLIENT = httpx.AsyncClient(
+            http2=True,  # multiplex concurrent fetches over one TLS connection
+            headers=_github_headers(),
+            limits=httpx.Limits(max_keepalive_connections=20, max_connections=100),
+            timeout=httpx.Timeout(10.0, connect=5.0),
+        )
+    return GITHUB_CLIENT
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    client = _github_client()
+    try:
+        yield
+    finally:
+        global GITHUB_CLIENT
+        GITHUB_CLIENT = None
+        await client.aclose()
+
+# orjson-based responses: C-serialized JSON beats the default encoder on
+# the multi-KB explanation payloads returned by /check-microcase/
+app = FastAPI(default_response_class=ORJSONResponse, lifespan=lifespan)
 
 # Simple in-memory session storage for SSE
 SESSIONS: dict[str, asyncio.Queue] = {}
@@ -47,30 +91,53 @@ def sse_format(event: str, data: dict) -> bytes:
     return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n".encode("utf-8")
 
 class GenerateMicrocaseRequest(BaseModel):
+    model_config = {"extra": "ignore"}
+
     url: str
     user_id: str
 
 class CheckMicrocaseRequest(BaseModel):
+    model_config = {"extra": "ignore"}
+
     user_id: str
     microcase_id: Union[int, str]
     solution: str
     pr_url: Optional[str] = None
 
 class EvaluateReviewRequest(BaseModel):
+    model_config = {"extra": "ignore"}
+
     user_id: str
     review: str
     pr_url: Optional[str] = None
 
+@lru_cache(maxsize=1024)
 def parse_github_pr_url(url: str) -> Optional[tuple[str, str, str]]:
     """Parse GitHub PR URL to extract owner, repo, and PR number."""
-    pattern = r"https://github\.com/([^/]+)/([^/]+)/pull/(\d+)"
-    match = re.match(pattern, url)
-    if match:
-        return match.groups()
+    # urlsplit + split beats a regex for this single well-known URL shape
+    parts = urlsplit(url)
+    if parts.scheme != "https" or parts.netloc != "github.com":
+        return None
+    segments = parts.path.strip("/").split("/")
+    if len(segments) >= 4 and segments[0] and segments[1] and segments[2] == "pull" and segments[3].isdigit():
+        return segments[0], segments[1], segments[3]
     return None
 
+@lru_cache(maxsize=256)
 def _hash_pull_request_url(url: str) -> str:
-    return hashlib.sha256(url.encode("utf-8")).hexdigest()
+    # BLAKE2b is faster than SHA-256 on short inputs and 16 bytes is plenty
+    # for a storage-dir name; cached so each distinct URL is hashed once.
+    return hashlib.blake2b(url.encode("utf-8"), digest_size=16).hexdigest()
+
+@lru_cache(maxsize=1024)
+def _read_cached(path: str, mtime_ns: int, size: int) -> str:
+    # mtime_ns/size are part of the key so a changed file misses the cache
+    return Path(path).read_text(encoding="utf-8")
+
+def _read_text_cached(path: Path) -> str:
+    """Read a file with an in-process cache keyed by (path, mtime, size)."""
+    st = os.stat(path)
+    return _read_cached(str(path), st.st_mtime_ns, st.st_size)
 
 def _write_json(path: Path, data: dict) -> None:
     path.write_text(json.dumps(data, ensure_ascii=False, indent=2), encoding="utf-8")
@@ -154,175 +221,488 @@ def _cache_microcases(pr_url: str, session_dir: Path) -> None:
         }
         _write_json(micro_dir / "microcase.json", meta)
 
-async def fetch_pr_comments(owner: str, repo: str, pr_number: str) -> list:
+async def _github_get(url: str, *, attempts: int = 5, **kwargs) -> httpx.Response:
+    """GET with retries on GitHub rate-limit responses (403/429).
+
+    Honors Retry-After when present, otherwise waits until the rate-limit
+    window resets (capped), with jitter so concurrent fetches don't retry
+    in lockstep.
+    """
+    client = _github_client()
+    response = None
+    for attempt in range(attempts):
+        response = await client.get(url, **kwargs)
+        if response.status_code not in (403, 429):
+            return response
+        headers_lower = {k.lower(): v for k, v in response.headers.items()}
+        retry_after = headers_lower.get("retry-after")
+        if retry_after is not None:
+            delay = float(retry_after)
+        elif headers_lower.get("x-ratelimit-remaining") == "0":
+            reset = headers_lower.get("x-ratelimit-reset")
+            delay = max(0.0, float(reset) - time.time()) if reset else 2 ** attempt
+        else:
+            # Plain 403 (permissions etc.) — retrying won't help
+            return response
+        if attempt + 1 < attempts:
+            await asyncio.sleep(min(delay, 60.0) + random.uniform(0, 0.5))
+    return response
+
+# cache key → (etag, parsed body, last page). A 304 on If-None-Match doesn't
+# count against the GitHub rate limit, so revisiting an unchanged PR is free.
+_ETAG_CACHE: dict[str, tuple[str, list, int]] = {}
+
+def _last_page_from_link(link_header: Optional[str]) -> int:
+    """Extract the rel=\"last\" page number from a GitHub Link header."""
+    if not link_header:
+        return 1
+    for part in link_header.split(","):
+        if 'rel="last"' in part:
+            target = part[part.find("<") + 1:part.find(">")]
+            page = parse_qs(urlsplit(target).query).get("page")
+            if page and page[0].isdigit():
+                return int(page[0])
+    return 1
+
+async def _get_json_conditional(url: str, page: int = 1) -> tuple[Optional[list], int]:
+    """GET one page of a JSON list endpoint with If-None-Match.
+
+    Returns (items, last_page); serves the cached body on 304.
+    """
+    params = {"per_page": 100, "page": page}
+    cache_key = f"{url}?page={page}"
+    cached = _ETAG_CACHE.get(cache_key)
+    headers = {"If-None-Match": cached[0]} if cached else None
+    response = await _github_get(url, headers=headers, params=params)
+    if response.status_code == 304 and cached:
+        return cached[1], cached[2]
+    if response.status_code == 200:
+        data = orjson.loads(response.content)
+        last_page = _last_page_from_link(response.headers.get("link"))
+        etag = response.headers.get("etag")
+        if etag:
+            _ETAG_CACHE[cache_key] = (etag, data, last_page)
+        return data, last_page
+    return None, 1
+
+async def _fetch_all_pages(url: str) -> list:
+    """Fetch every page of a GitHub list endpoint, pages 2+ concurrently."""
+    data, last_page = await _get_json_conditional(url)
+    if data is None:
+        return []
+    items = list(data)
+    if last_page > 1:
+        page_results = await asyncio.gather(
+            *[_get_json_conditional(url, page) for page in range(2, last_page + 1)],
+            return_exceptions=True
+        )
+        for result in page_results:
+            if isinstance(result, Exception):
+                continue
+            page_data, _ = result
+            if page_data:
+                items.extend(page_data)
+    return items
+
+# Short-TTL cache so a PR polled repeatedly during a session doesn't hit
+# GitHub at all between refreshes (the ETag layer makes refreshes cheap too)
+_PR_COMMENTS_TTL = 30.0
+_PR_COMMENTS_CACHE: dict[tuple[str, str, str], tuple[float, list]] = {}
+
+async def fetch_pr_comments(owner: str, repo: str, pr_number: str, force: bool = False) -> list:
     """Fetch all comments from a GitHub PR."""
-    github_token = os.getenv("GITHUB_TOKEN")
-    headers = {}
-    if github_token:
-        headers["Authorization"] = f"token {github_token}"
-    
+    cache_key = (owner, repo, pr_number)
+    if not force:
+        cached = _PR_COMMENTS_CACHE.get(cache_key)
+        if cached and time.time() - cached[0] < _PR_COMMENTS_TTL:
+            return cached[1]
+
     comments = []
-    
-    async with httpx.AsyncClient() as client:
-        # Fetch PR review comments
-        review_comments_url = f"https://api.github.com/repos/{owner}/{repo}/pulls/{pr_number}/comments"
-        response = await client.get(review_comments_url, headers=headers)
-        if response.status_code == 200:
-            comments.extend(response.json())
-        
-        # Fetch issue comments (general PR comments)
-        issue_comments_url = f"https://api.github.com/repos/{owner}/{repo}/issues/{pr_number}/comments"
-        response = await client.get(issue_comments_url, headers=headers)
-        if response.status_code == 200:
-            comments.extend(response.json())
-    
+
+    # Review comments and issue comments are independent endpoints —
+    # fetch them concurrently, fully paginated, with conditional requests
+    review_comments_url = f"https://api.github.com/repos/{owner}/{repo}/pulls/{pr_number}/comments"
+    issue_comments_url = f"https://api.github.com/repos/{owner}/{repo}/issues/{pr_number}/comments"
+    results = await asyncio.gather(
+        _fetch_all_pages(review_comments_url),
+        _fetch_all_pages(issue_comments_url),
+        return_exceptions=True
+    )
+
+    for result in results:
+        if isinstance(result, Exception) or result is None:
+            continue
+        comments.extend(result)
+
+    _PR_COMMENTS_CACHE[cache_key] = (time.time(), comments)
     return comments
 
+# One GraphQL query returns head SHA/repo and all comments in a single
+# round-trip, replacing the PR-details GET plus two comment-endpoint GETs
+_PR_GRAPHQL_QUERY = """
+query($o: String!, $r: String!, $n: Int!) {
+  repository(owner: $o, name: $r) {
+    pullRequest(number: $n) {
+      headRefOid
+      headRepository { name owner { login } }
+      reviews(first: 100) {
+        nodes {
+          comments(first: 100) {
+            nodes { path line originalLine startLine body author { login } }
+          }
+        }
+      }
+      comments(first: 100) { nodes { body author { login } } }
+    }
+  }
+}
+"""
+
+async def fetch_pr_via_graphql(owner: str, repo: str, pr_number: str) -> Optional[tuple[dict, list]]:
+    """Fetch PR details and comments in one GraphQL round-trip.
+
+    Returns (pr_details, comments) shaped like the REST helpers, or None
+    when GraphQL is unavailable (no token, query error) so the caller can
+    fall back to the REST path.
+    """
+    if not os.getenv("GITHUB_TOKEN"):
+        return None  # GraphQL requires authentication
+    client = _github_client()
+    try:
+        response = await client.post(
+            "https://api.github.com/graphql",
+            json={"query": _PR_GRAPHQL_QUERY, "variables": {"o": owner, "r": repo, "n": int(pr_number)}}
+        )
+    except Exception:
+        return None
+    if response.status_code != 200:
+        return None
+    try:
+        data = orjson.loads(response.content)
+        pr = ((data.get("data") or {}).get("repository") or {}).get("pullRequest")
+    except Exception:
+        return None
+    if not pr:
+        return None
+
+    head_repo = pr.get("headRepository") or {}
+    pr_details = {
+        "head_owner": (head_repo.get("owner") or {}).get("login", owner),
+        "head_repo": head_repo.get("name", repo),
+        "head_sha": pr.get("headRefOid"),
+    }
+
+    # Flatten into the REST comment shape the rest of the handler expects
+    comments = []
+    for review in ((pr.get("reviews") or {}).get("nodes") or []):
+        for c in ((review.get("comments") or {}).get("nodes") or []):
+            comments.append({
+                "path": c.get("path"),
+                "line": c.get("line"),
+                "original_line": c.get("originalLine"),
+                "start_line": c.get("startLine"),
+                "body": c.get("body") or "",
+                "user": {"login": (c.get("author") or {}).get("login") or "Unknown"},
+            })
+    for c in ((pr.get("comments") or {}).get("nodes") or []):
+        comments.append({
+            "path": None,
+            "body": c.get("body") or "",
+            "user": {"login": (c.get("author") or {}).get("login") or "Unknown"},
+        })
+    return pr_details, comments
+
 async def fetch_pr_details(owner: str, repo: str, pr_number: str) -> dict:
     """Fetch PR details to obtain head repo info and SHA (supports forks)."""
     github_token = os.getenv("GITHUB_TOKEN")
-    headers = {}
-    if github_token:
-        headers["Authorization"] = f"token {github_token}"
 
     pr_url = f"https://api.github.com/repos/{owner}/{repo}/pulls/{pr_number}"
-    async with httpx.AsyncClient() as client:
-        response = await client.get(pr_url, headers=headers)
-        if response.status_code != 200:
-            # Build structured diagnostics for better troubleshooting (403, rate limits, scopes, SSO)
-            provider_message = None
-            documentation_url = None
-            provider_body_text = None
-            try:
-                err_json = response.json()
-                provider_message = err_json.get("message")
-                documentation_url = err_json.get("documentation_url")
-                provider_body_text = json.dumps(err_json)
-            except Exception:
-                try:
-                    provider_body_text = (response.text or "")
-                except Exception:
-                    provider_body_text = None
-
-            headers_lower = {k.lower(): v for k, v in response.headers.items()}
-            diagnostics = {
-                "message": "Failed to fetch PR details",
-                "provider_status": response.status_code,
-                "provider_message": provider_message,
-                "documentation_url": documentation_url,
-                "request_url": pr_url,
-                "token_present": bool(github_token),
-                "rate_limit": {
-                    "limit": headers_lower.get("x-ratelimit-limit"),
-                    "remaining": headers_lower.get("x-ratelimit-remaining"),
-                    "reset": headers_lower.get("x-ratelimit-reset"),
-                },
-                "oauth_scopes": headers_lower.get("x-oauth-scopes"),
-                "accepted_oauth_scopes": headers_lower.get("x-accepted-oauth-scopes"),
-                "sso": headers_lower.get("x-github-sso"),
-                "provider_body": (provider_body_text or "")[:1000] or None,
-            }
-            logger = get_logger()
+    response = await _github_get(pr_url)
+    if response.status_code != 200:
+        # Build structured diagnostics for better troubleshooting (403, rate limits, scopes, SSO)
+        provider_message = None
+        documentation_url = None
+        provider_body_text = None
+        try:
+            err_json = orjson.loads(response.content)
+            provider_message = err_json.get("message")
+            documentation_url = err_json.get("documentation_url")
+            provider_body_text = json.dumps(err_json)
+        except Exception:
             try:
-                # Avoid logging large bodies
-                log_copy = {k: v for k, v in diagnostics.items() if k != "provider_body"}
-                logger.warning(f"PR details fetch failed: {json.dumps(log_copy, ensure_ascii=False)}")
+                provider_body_text = (response.text or "")
             except Exception:
-                logger.warning("PR details fetch failed (could not serialize diagnostics)")
-            raise HTTPException(status_code=502, detail=diagnostics)
-        data = response.json()
-        head = data.get("head", {})
-        head_repo = head.get("repo") or {}
-        return {
-            "head_owner": (head_repo.get("owner") or {}).get("login", owner),
-            "head_repo": head_repo.get("name", repo),
-            "head_sha": head.get("sha"),
+                provider_body_text = None
+
+        headers_lower = {k.lower(): v for k, v in response.headers.items()}
+        diagnostics = {
+            "message": "Failed to fetch PR details",
+            "provider_status": response.status_code,
+            "provider_message": provider_message,
+            "documentation_url": documentation_url,
+            "request_url": pr_url,
+            "token_present": bool(github_token),
+            "rate_limit": {
+                "limit": headers_lower.get("x-ratelimit-limit"),
+                "remaining": headers_lower.get("x-ratelimit-remaining"),
+                "reset": headers_lower.get("x-ratelimit-reset"),
+            },
+            "oauth_scopes": headers_lower.get("x-oauth-scopes"),
+            "accepted_oauth_scopes": headers_lower.get("x-accepted-oauth-scopes"),
+            "sso": headers_lower.get("x-github-sso"),
+            "provider_body": (provider_body_text or "")[:1000] or None,
         }
+        logger = get_logger()
+        try:
+            # Avoid logging large bodies
+            log_copy = {k: v for k, v in diagnostics.items() if k != "provider_body"}
+            logger.warning(f"PR details fetch failed: {json.dumps(log_copy, ensure_ascii=False)}")
+        except Exception:
+            logger.warning("PR details fetch failed (could not serialize diagnostics)")
+        raise HTTPException(status_code=502, detail=diagnostics)
+    data = orjson.loads(response.content)
+    head = data.get("head", {})
+    head_repo = head.get("repo") or {}
+    return {
+        "head_owner": (head_repo.get("owner") or {}).get("login", owner),
+        "head_repo": head_repo.get("name", repo),
+        "head_sha": head.get("sha"),
+    }
+
+# On-disk cache for file content at an immutable ref (commit SHA):
+# content at a fixed SHA never changes, so entries never expire
+GH_FILE_CACHE_DIR = Path("tmp") / "pytasksyn-backend" / "gh-cache"
+
+def _is_immutable_ref(ref: str) -> bool:
+    return len(ref) == 40 and all(c in "0123456789abcdef" for c in ref.lower())
+
+def _gh_cache_path(owner: str, repo: str, ref: str, file_path: str) -> Path:
+    key = hashlib.blake2b(f"{owner}/{repo}/{ref}/{file_path}".encode("utf-8"), digest_size=16).hexdigest()
+    return GH_FILE_CACHE_DIR / key
 
 async def fetch_github_file_content(owner: str, repo: str, file_path: str, ref: str = "HEAD") -> str:
     """Fetch file content from GitHub repository"""
-    github_token = os.getenv("GITHUB_TOKEN")
-    headers = {}
-    if github_token:
-        headers["Authorization"] = f"token {github_token}"
-    
+    client = _github_client()
+
+    # Serve from the on-disk cache when the ref is a commit SHA
+    cache_path = _gh_cache_path(owner, repo, ref, file_path) if _is_immutable_ref(ref) else None
+    if cache_path is not None and cache_path.exists():
+        try:
+            return cache_path.read_text(encoding='utf-8')
+        except Exception:
+            pass
+
+    content = None
+
     # Use Contents API to fetch file
     contents_url = f"https://api.github.com/repos/{owner}/{repo}/contents/{file_path}"
     params = {"ref": ref}
-    
-    async with httpx.AsyncClient() as client:
-        response = await client.get(contents_url, headers=headers, params=params)
-        if response.status_code == 200:
-            file_data = response.json()
-            if file_data.get('encoding') == 'base64':
-                import base64
-                content = base64.b64decode(file_data['content']).decode('utf-8')
-                return content
-        
+
+    response = await _github_get(contents_url, params=params)
+    if response.status_code == 200:
+        file_data = orjson.loads(response.content)
+        if file_data.get('encoding') == 'base64':
+            import base64
+            content = base64.b64decode(file_data['content']).decode('utf-8')
+
+    if content is None:
         # If Contents API fails, try Raw API
         raw_url = f"https://raw.githubusercontent.com/{owner}/{repo}/{ref}/{file_path}"
-        response = await client.get(raw_url, headers=headers)
+        response = await _github_get(raw_url)
         if response.status_code == 200:
-            return response.text
+            content = response.text
+
+    if content is not None:
+        if cache_path is not None:
+            try:
+                cache_path.parent.mkdir(parents=True, exist_ok=True)
+                cache_path.write_text(content, encoding='utf-8')
+            except Exception:
+                pass
+        return content
     
     raise Exception(f"Could not fetch file {file_path} from {owner}/{repo}")
 
+# Above this size the tarball costs more than per-file GETs for the handful
+# of files a PR usually touches — the caller falls back to those instead
+TARBALL_MAX_BYTES = int(os.getenv("PYTASKSYN_TARBALL_MAX_BYTES", str(50 * 1024 * 1024)))
+
+async def _fetch_project_tarball(owner: str, repo: str, ref: str, file_paths: list, project_dir: Path) -> set:
+    """Download the repo tarball once and extract only the needed files.
+
+    Returns the set of file paths actually written. Raises on a failed or
+    oversized tarball download so the caller can fall back to per-file
+    fetches — for a large repo the full archive is a worse deal than a
+    few Contents-API calls.
+    """
+    client = _github_client()
+    tarball_url = f"https://api.github.com/repos/{owner}/{repo}/tarball/{ref}"
+    # Stream the body chunk-by-chunk: tarballs can be tens of MB and
+    # response.content would buffer it all in one allocation. The spool
+    # keeps small tarballs in memory and spills big ones to disk.
+    spool = tempfile.SpooledTemporaryFile(max_size=16 * 1024 * 1024)
+    downloaded = 0
+    try:
+        async with client.stream("GET", tarball_url, follow_redirects=True) as response:
+            if response.status_code != 200:
+                raise Exception(f"Tarball fetch failed with status {response.status_code}")
+            content_length = response.headers.get("Content-Length")
+            if content_length and int(content_length) > TARBALL_MAX_BYTES:
+                raise Exception(
+                    f"Tarball is {content_length} bytes (limit {TARBALL_MAX_BYTES}), "
+                    "using per-file fetches instead")
+            async for chunk in response.aiter_bytes():
+                downloaded += len(chunk)
+                if downloaded > TARBALL_MAX_BYTES:
+                    # GitHub often omits Content-Length here — enforce the cap
+                    # on the stream itself and stop paying for the rest
+                    raise Exception(
+                        f"Tarball exceeded {TARBALL_MAX_BYTES} bytes while streaming, "
+                        "using per-file fetches instead")
+                spool.write(chunk)
+    except Exception:
+        spool.close()
+        raise
+    spool.seek(0)
+
+    def _extract() -> set:
+        wanted = set(file_paths)
+        written: set = set()
+        created_dirs: set = set()
+        with tarfile.open(fileobj=spool, mode="r:gz") as tar:
+            for member in tar:
+                if not member.isfile():
+                    continue
+                # Strip the "<owner>-<repo>-<sha>/" top-level prefix
+                rel_path = member.name.split("/", 1)[1] if "/" in member.name else member.name
+                if rel_path not in wanted:
+                    continue
+                fobj = tar.extractfile(member)
+                if fobj is None:
+                    continue
+                local_file = project_dir / rel_path
+                if local_file.parent not in created_dirs:
+                    local_file.parent.mkdir(parents=True, exist_ok=True)
+                    created_dirs.add(local_file.parent)
+                local_file.write_bytes(fobj.read())
+                written.add(rel_path)
+        return written
+
+    # Decompression and file writes are blocking — keep them off the loop
+    try:
+        return await asyncio.to_thread(_extract)
+    finally:
+        spool.close()
+
+# Single backend module for both real and mock operation: set
+# PYTASKSYN_MOCK_PROJECT=1 to skip GitHub entirely and write stub files,
+# instead of maintaining a second near-identical main.py for mocking
+MOCK_PROJECT = os.getenv("PYTASKSYN_MOCK_PROJECT") == "1"
+
 async def create_project_from_github(owner: str, repo: str, review_comments: list, project_dir: Path, ref: str = "HEAD"):
     """Create project structure by fetching real files from GitHub"""
     # Get unique file paths from comments
     file_paths = list(set(comment['path'] for comment in review_comments))
-    
+
     logger = get_logger()
+
+    if MOCK_PROJECT:
+        logger.info(f"Mock mode: creating {len(file_paths)} stub files instead of fetching")
+
+        def _write_mocks():
+            for parent in {(project_dir / p).parent for p in file_paths}:
+                parent.mkdir(parents=True, exist_ok=True)
+            for file_path in file_paths:
+                (project_dir / file_path).write_text(f"# Mock content for {file_path}\n", encoding='utf-8')
+
+        await asyncio.to_thread(_write_mocks)
+        return
+
     logger.info(f"Fetching {len(file_paths)} files from GitHub repo {owner}/{repo}")
-    
-    for file_path in file_paths:
-        try:
-            logger.info(f"Fetching file: {file_path}")
-            content = await fetch_github_file_content(owner, repo, file_path, ref)
-            
-            # Create local file
-            local_file = project_dir / file_path
-            local_file.parent.mkdir(parents=True, exist_ok=True)
-            local_file.write_text(content, encoding='utf-8')
-            
+
+    # One tarball round-trip replaces N Contents-API calls; fall back to
+    # per-file fetches for anything the tarball didn't cover
+    try:
+        written = await _fetch_project_tarball(owner, repo, ref, file_paths, project_dir)
+        logger.info(f"Extracted {len(written)}/{len(file_paths)} files from tarball")
+        file_paths = [p for p in file_paths if p not in written]
+        if not file_paths:
+            return
+    except Exception as e:
+        logger.warning(f"Tarball fetch failed, falling back to per-file fetches: {e}")
+
+    # Fetch files concurrently; the semaphore keeps us under GitHub's
+    # secondary rate limits
+    sem = asyncio.Semaphore(10)
+
+    async def _fetch_one(file_path: str):
+        async with sem:
+            try:
+                content = await fetch_github_file_content(owner, repo, file_path, ref)
+                return file_path, content, None
+            except Exception as e:
+                return file_path, None, e
+
+    results = await asyncio.gather(*[_fetch_one(p) for p in file_paths])
+
+    def _write_results():
+        # Create each unique parent dir once instead of per file
+        fetched = [(fp, content) for fp, content, error in results if error is None]
+        for parent in {(project_dir / fp).parent for fp, _ in fetched}:
+            parent.mkdir(parents=True, exist_ok=True)
+        for file_path, content in fetched:
+            (project_dir / file_path).write_text(content, encoding='utf-8')
             logger.info(f"Successfully saved: {file_path}")
-            
-        except Exception as e:
-            logger.warning(f"Could not fetch {file_path}: {e}")
-            # Create a minimal placeholder file for missing files
-            local_file = project_dir / file_path
-            local_file.parent.mkdir(parents=True, exist_ok=True)
-            local_file.write_text(f"# Could not fetch original file: {e}\n# File: {file_path}\n", encoding='utf-8')
+
+        # No per-file placeholders for unreachable files — record them all
+        # in a single manifest instead (downstream stages already fall
+        # back gracefully when a source file is absent)
+        missing = [(fp, str(error)) for fp, _, error in results if error is not None]
+        if missing:
+            for file_path, error_text in missing:
+                logger.warning(f"Could not fetch {file_path}: {error_text}")
+            (project_dir / ".missing_files.json").write_text(
+                json.dumps([{"file_path": fp, "error": err} for fp, err in missing], ensure_ascii=False, indent=2),
+                encoding='utf-8'
+            )
+
+    # File writes are blocking syscalls — keep them off the event loop
+    await asyncio.to_thread(_write_results)
 
 async def create_review_csv_from_comments(comments: list, temp_dir: Path) -> Path:
     """Create a CSV file from PR comments in the expected format for pytasksyn"""
     csv_path = temp_dir / "code_review.csv"
-    
-    with open(csv_path, 'w', newline='', encoding='utf-8') as f:
-        writer = csv.writer(f)
-        # Write header matching expected format
-        writer.writerow(['comment_id', 'file_path', 'line_number', 'comment', 'author'])
-        
-        comment_id = 1
-        for comment in comments:
-            # Prefer original line fields; fallback to current line or range starts
-            if comment.get('path'):
-                line_number = (
-                    comment.get('original_line')
-                    or comment.get('line')
-                    or comment.get('original_start_line')
-                    or comment.get('start_line')
-                )
-                if line_number is not None:
-                    writer.writerow([
-                        comment_id,
-                        comment['path'],
-                        int(line_number),
-                        comment.get('body', ''),
-                        comment.get('user', {}).get('login', 'Unknown')
-                    ])
-                    comment_id += 1
-    
+    # CSV writing is blocking I/O — run it in a worker thread
+    return await asyncio.to_thread(_write_review_csv, comments, csv_path)
+
+def _write_review_csv(comments: list, csv_path: Path) -> Path:
+    # Build the CSV in memory and flush it with a single write call
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    # Write header matching expected format
+    writer.writerow(['comment_id', 'file_path', 'line_number', 'comment', 'author'])
+
+    comment_id = 1
+    for comment in comments:
+        # Prefer original line fields; fallback to current line or range starts
+        if comment.get('path'):
+            line_number = (
+                comment.get('original_line')
+                or comment.get('line')
+                or comment.get('original_start_line')
+                or comment.get('start_line')
+            )
+            if line_number is not None:
+                writer.writerow([
+                    comment_id,
+                    comment['path'],
+                    int(line_number),
+                    comment.get('body', ''),
+                    comment.get('user', {}).get('login', 'Unknown')
+                ])
+                comment_id += 1
+
+    csv_path.write_text(buf.getvalue(), encoding='utf-8', newline='')
     return csv_path
 
 @app.post("/gen-microcases/", status_code=202)
@@ -342,14 +722,19 @@ async def generate_microcases(request: GenerateMicrocaseRequest):
     logger.info(f"Parsed PR info - Owner: {owner}, Repo: {repo}, PR: {pr_number}")
     
     try:
-        # Fetch PR details for head repo/sha (supports forks)
-        pr_details = await fetch_pr_details(owner, repo, pr_number)
+        # One GraphQL round-trip for PR details + comments; fall back to
+        # the REST helpers when GraphQL is unavailable
+        graphql_result = await fetch_pr_via_graphql(owner, repo, pr_number)
+        if graphql_result is not None:
+            pr_details, comments = graphql_result
+        else:
+            # Fetch PR details for head repo/sha (supports forks)
+            pr_details = await fetch_pr_details(owner, repo, pr_number)
+            # Fetch all comments from the PR
+            comments = await fetch_pr_comments(owner, repo, pr_number)
         head_owner = pr_details["head_owner"]
         head_repo = pr_details["head_repo"]
         head_sha = pr_details["head_sha"]
-
-        # Fetch all comments from the PR
-        comments = await fetch_pr_comments(owner, repo, pr_number)
         
         logger.info(f"Found {len(comments)} comments in PR #{pr_number}")
         
@@ -372,7 +757,7 @@ async def generate_microcases(request: GenerateMicrocaseRequest):
         
         if not review_comments:
             logger.warning("No review comments found with file paths - cannot generate microcases")
-            return JSONResponse({
+            return ORJSONResponse({
                 "message": "No review comments with file paths found",
                 "url": request.url,
                 "user_id": request.user_id,
@@ -393,12 +778,9 @@ async def generate_microcases(request: GenerateMicrocaseRequest):
         # Fetch real files from the PR head repository and commit
         await create_project_from_github(head_owner, head_repo, review_comments, project_dir, ref=head_sha or "HEAD")
         
-        # Create temporary directory for CSV file
-        temp_dir_obj = tempfile.TemporaryDirectory()
-        temp_dir = Path(temp_dir_obj.name)
-        
-        # Create CSV from PR comments
-        review_csv = await create_review_csv_from_comments(review_comments, temp_dir)
+        # Create CSV from PR comments directly in the session dir — no
+        # separate TemporaryDirectory lifetime to manage
+        review_csv = await create_review_csv_from_comments(review_comments, session_dir)
         
         # Minimal config
         config = {
@@ -443,6 +825,8 @@ async def generate_microcases(request: GenerateMicrocaseRequest):
             init_logger(session_dir, console_output=True)
             prod_logger = get_logger()
             try:
+                from pytasksyn.main import run_pipeline
+
                 # Run pipeline in a thread to avoid blocking event loop
                 results = await asyncio.to_thread(run_pipeline, config, session_dir)
 
@@ -500,14 +884,9 @@ async def generate_microcases(request: GenerateMicrocaseRequest):
                 prod_logger.error(f"SSE producer failed: {e}")
                 await queue.put(("error", {"message": str(e)}))
                 await queue.put(("complete", {"message": "Завершено с ошибкой", "total_accepted": 0}))
-            finally:
-                try:
-                    temp_dir_obj.cleanup()
-                except Exception:
-                    pass
 
         asyncio.create_task(_producer())
-        return JSONResponse({"session_id": session_id}, status_code=202)
+        return ORJSONResponse({"session_id": session_id}, status_code=202)
         
     except HTTPException:
         raise  # Re-raise HTTP exceptions
@@ -683,6 +1062,7 @@ async def evaluate_review(request: EvaluateReviewRequest):
 
     # Load all microcases and expert solutions
     all_microcases: list[dict] = []
+    expert_solution_paths: dict[int, Path] = {}
     expert_solutions: dict[int, str] = {}
     student_solutions: dict[int, str] = {}
 
@@ -703,28 +1083,46 @@ async def evaluate_review(request: EvaluateReviewRequest):
                 "line_number": meta.get("line_number"),
                 "microcase": meta.get("microcase_text") or ""
             })
-            # Expert solution
-            exp_path = mc_dir / "solution_expert.py"
-            if mc_id is not None and exp_path.exists():
-                try:
-                    expert_solutions[mc_id] = exp_path.read_text(encoding="utf-8")
-                except Exception:
-                    pass
+            if mc_id is None:
+                continue
+            # One scandir per microcase dir instead of per-file exists() stats
+            try:
+                with os.scandir(mc_dir) as it:
+                    entries = {e.name: e for e in it}
+            except OSError:
+                continue
+            # Expert solution: record the path only; read after we know the
+            # request is viable (the user solved at least one microcase)
+            if "solution_expert.py" in entries:
+                expert_solution_paths[mc_id] = mc_dir / "solution_expert.py"
             # Student solution for this user (if exists)
-            stu_path = mc_dir / "student_solutions" / f"{request.user_id}.py"
-            if mc_id is not None and stu_path.exists():
+            student_name = f"{request.user_id}.py"
+            if "student_solutions" in entries and entries["student_solutions"].is_dir():
                 try:
-                    student_solutions[mc_id] = stu_path.read_text(encoding="utf-8")
-                except Exception:
-                    pass
+                    with os.scandir(entries["student_solutions"].path) as it:
+                        has_student = any(e.name == student_name for e in it)
+                except OSError:
+                    has_student = False
+                if has_student:
+                    try:
+                        student_solutions[mc_id] = _read_text_cached(mc_dir / "student_solutions" / student_name)
+                    except Exception:
+                        pass
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to load microcases: {e}")
 
-    # Build prompt context
+    # Short-circuit before any expert reads or prompt formatting
     solved_ids = sorted(k for k in student_solutions.keys())
     if not solved_ids:
         raise HTTPException(status_code=409, detail="No solved microcases found for this user")
 
+    # Now that the request is viable, load expert solutions
+    for mc_id, exp_path in expert_solution_paths.items():
+        try:
+            expert_solutions[mc_id] = _read_text_cached(exp_path)
+        except Exception:
+            pass
+
     def _fmt_cases(cases: list[dict]) -> str:
         parts = []
         for c in cases:
@@ -736,16 +1134,15 @@ async def evaluate_review(request: EvaluateReviewRequest):
             parts.append(f"- ID {cid} {('('+loc+')') if loc else ''}:\n{body}\n")
         return "\n".join(parts)
 
-    def _fmt_code_map(code_map: dict[int, str], title: str) -> str:
+    def _fmt_code_map(items: list[tuple[int, str]], title: str) -> str:
         lines = [title]
-        for cid in sorted(code_map.keys()):
-            code = code_map[cid]
+        for cid, code in items:
             lines.append(f"[ID {cid}]\n```python\n{code}\n```\n")
         return "\n".join(lines)
 
     all_cases_text = _fmt_cases(all_microcases)
-    expert_code_text = _fmt_code_map({cid: expert_solutions.get(cid, '') for cid in sorted(expert_solutions.keys())}, "Эталонные решения (эксперт):")
-    student_code_text = _fmt_code_map({cid: student_solutions[cid] for cid in solved_ids}, "Решения студента (только решённые):")
+    expert_code_text = _fmt_code_map(sorted(expert_solutions.items()), "Эталонные решения (эксперт):")
+    student_code_text = _fmt_code_map([(cid, student_solutions[cid]) for cid in solved_ids], "Решения студента (только решённые):")
 
     prompt = (
         "Ты — преподаватель программирования. Оцени, насколько хорошо студент усвоил материал по решённым им микро-кейсам.\n"
@@ -762,18 +1159,16 @@ async def evaluate_review(request: EvaluateReviewRequest):
     model_provider = os.getenv("REVIEW_PROVIDER", "yandex")
     model_name = os.getenv("REVIEW_MODEL", "yandexgpt-lite")
     try:
+        from pytasksyn.main import create_llm
         llm = create_llm({"provider": model_provider, "model_name": model_name})
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"LLM init failed: {e}")
 
-    # Invoke LLM
+    # Invoke LLM: resolve the interface once instead of paying a raised
+    # exception per request on providers without .invoke
+    llm_call = getattr(llm, "invoke", None) or llm
     try:
-        response = None
-        try:
-            response = llm.invoke(prompt)  # type: ignore
-        except Exception:
-            # Fallback to callable interface
-            response = llm(prompt)  # type: ignore
+        response = llm_call(prompt)  # type: ignore
         if hasattr(response, "content"):
             text = getattr(response, "content")
         else:
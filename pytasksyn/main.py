@@ -2,26 +2,30 @@
 import os
 import sys
 import argparse
+import copy
 import yaml
-import json
+import orjson
 import shutil
 from datetime import datetime
+from functools import lru_cache
 from pathlib import Path
-from dotenv import load_dotenv
-from langchain.prompts import PromptTemplate
-from langchain_community.llms.yandex import YandexGPT
-from langchain_openai import ChatOpenAI
-from langchain_core.output_parsers import StrOutputParser
-
-# Import stages
-from pytasksyn.stages.preprocessing import PreprocessingStage
-from pytasksyn.stages.expert import ExpertStage
-from pytasksyn.stages.tutor import TutorStage
-from pytasksyn.stages.student import StudentStage
 
 # Import logging utilities
 from pytasksyn.utils.logging_utils import init_logger, get_logger
 
+# Используем C-реализацию libyaml, когда она собрана; иначе чистый Python
+try:
+    from yaml import CSafeLoader as _YamlLoader, CSafeDumper as _YamlDumper
+except ImportError:
+    from yaml import SafeLoader as _YamlLoader, SafeDumper as _YamlDumper
+
+
+@lru_cache(maxsize=8)
+def _parse_config_file(config_path: str, mtime_ns: int):
+    """Parse a YAML config, memoized on (path, mtime)"""
+    with open(config_path, 'r') as f:
+        return yaml.load(f, Loader=_YamlLoader)
+
 def parse_args():
     parser = argparse.ArgumentParser(description='PyTaskSyn — генерация микро-кейсов из обзоров кода')
     
@@ -55,6 +59,9 @@ def parse_args():
     parser.add_argument('--tutor-max-solution-attempts', type=int, help='Максимум попыток решения для этапа наставника')
     parser.add_argument('--tutor-acceptance-threshold', type=float, help='Минимальная оценка для принятия микро-кейса')
     
+    # Cache settings
+    parser.add_argument('--no-cache', action='store_true', help='Отключить кэш LLM-ответов и кэш результатов эксперта')
+
     # Student settings
     parser.add_argument('--num-students', type=int, help='Количество симулированных студентов')
     parser.add_argument('--student-comprehension-threshold', type=float, help='Минимальная доля успешных, чтобы принять микро-кейс')
@@ -71,8 +78,8 @@ def load_config(args=None):
     if not config_path.exists():
         raise ValueError(f"Файл конфигурации не найден: {config_path}")
     
-    with open(config_path, 'r') as f:
-        config = yaml.safe_load(f)
+    # Deep copy — CLI overrides mutate the config, the cached parse must stay pristine
+    config = copy.deepcopy(_parse_config_file(str(config_path), config_path.stat().st_mtime_ns))
     
     # Parse args if not provided
     if args is None:
@@ -92,16 +99,6 @@ def load_config(args=None):
     
     return config, args
 
-def merge_configs(base, override):
-    """Recursively merge two configuration dictionaries"""
-    result = base.copy()
-    for key, value in override.items():
-        if key in result and isinstance(result[key], dict) and isinstance(value, dict):
-            result[key] = merge_configs(result[key], value)
-        else:
-            result[key] = value
-    return result
-
 def apply_cli_overrides(config, args):
     """Apply CLI arguments to config"""
     # Model settings
@@ -171,48 +168,83 @@ def apply_cli_overrides(config, args):
         config['student']['num_students'] = args.num_students
     if args.student_comprehension_threshold is not None:
         config['student']['comprehension_threshold'] = args.student_comprehension_threshold
-    
+
+    # Cache settings
+    if getattr(args, 'no_cache', False):
+        config.setdefault('cache', {})
+        config['cache']['enable_llm_cache'] = False
+        config['cache']['expert_results_dir'] = ''
+
     return config
 
+REQUIRED_CONFIG_FIELDS = (
+    ('paths', 'student_project'),
+    ('paths', 'code_review_file')
+)
+
 def validate_config(config):
     """Validate that required configuration fields are present"""
-    required_fields = [
-        ('paths', 'student_project'),
-        ('paths', 'code_review_file')
-    ]
-    
-    for field_path in required_fields:
+    for field_path in REQUIRED_CONFIG_FIELDS:
         current = config
-        for key in field_path:
-            if key not in current:
-                raise ValueError(f"Требуемое поле конфигурации {'.'.join(field_path)} отсутствует")
-            current = current[key]
+        try:
+            for key in field_path:
+                current = current[key]
+        except (KeyError, TypeError):
+            raise ValueError(f"Требуемое поле конфигурации {'.'.join(field_path)} отсутствует")
         if not current:
             raise ValueError(f"Требуемое поле конфигурации {'.'.join(field_path)} пустое")
 
+_dotenv_loaded = False
+
+def _load_env_once():
+    """Load .env once per process — create_llm may be called per stage"""
+    global _dotenv_loaded
+    if not _dotenv_loaded:
+        from dotenv import load_dotenv
+        load_dotenv(Path(__file__).parent.parent / ".env")
+        _dotenv_loaded = True
+
 def create_llm(model_config):
-    """Create LLM instance based on configuration"""
-    script_dir = Path(__file__).parent
-    root_dir = script_dir.parent
-    load_dotenv(root_dir / ".env")
-    
-    provider = model_config['provider']
-    model_name = model_config['model_name']
-    
+    """Create LLM instance based on configuration.
+
+    Memoized on the model settings, so stages with an identical
+    provider/model share one client (and its connection pool).
+    """
+    _load_env_once()
+    return _create_llm_cached(
+        model_config['provider'],
+        model_config['model_name'],
+        model_config.get('temperature'),
+        bool(model_config.get('enable_prompt_cache'))
+    )
+
+@lru_cache(maxsize=None)
+def _create_llm_cached(provider, model_name, temperature, enable_prompt_cache):
+    # Импорты провайдеров отложены: langchain тянет сотни модулей,
+    # а --help и ошибки конфигурации до создания LLM не доходят
     if provider == 'yandex':
+        from langchain_community.llms.yandex import YandexGPT
+
         api_key = os.getenv("YANDEX_API_KEY")
         folder_id = os.getenv("YANDEX_FOLDER_ID")
         
         if not api_key or not folder_id:
             raise ValueError("YANDEX_API_KEY или YANDEX_FOLDER_ID не найдены в файле .env")
         
-        return YandexGPT(
-            api_key=api_key,
-            folder_id=folder_id,
-            model_name=model_name
-        )
+        yandex_kwargs = {
+            "api_key": api_key,
+            "folder_id": folder_id,
+            "model_name": model_name
+        }
+        # Детеминированная температура повышает отдачу от кэша ответов
+        if temperature is not None:
+            yandex_kwargs["temperature"] = temperature
+
+        return YandexGPT(**yandex_kwargs)
     
     elif provider == 'openai':
+        from langchain_openai import ChatOpenAI
+
         api_key = os.getenv("OPENAI_API_KEY")
         base_url = os.getenv("OPENAI_BASE_URL")
         
@@ -225,7 +257,13 @@ def create_llm(model_config):
         }
         if base_url:
             kwargs["base_url"] = base_url
-        
+        if temperature is not None:
+            kwargs["temperature"] = temperature
+        # Провайдеры с поддержкой кэширования промптов (Anthropic-совместимые
+        # шлюзы) переиспользуют статичный префикс промпта между запросами
+        if enable_prompt_cache:
+            kwargs["default_headers"] = {"anthropic-beta": "prompt-caching-2024-07-31"}
+
         return ChatOpenAI(**kwargs)
     
     else:
@@ -243,19 +281,41 @@ def setup_session_directory(config):
     # Save the actual config used for this run to session directory
     config_session_path = session_dir / "config_used.yml"
     with open(config_session_path, 'w') as f:
-        yaml.dump(config, f, default_flow_style=False)
+        yaml.dump(config, f, Dumper=_YamlDumper, default_flow_style=False)
     
     return session_dir
 
 def run_pipeline(config=None, session_dir=None):
     """Run the pipeline - can be called externally or from main()"""
+    # Этапы импортируют langchain — откладываем до реального запуска пайплайна
+    from pytasksyn.stages.preprocessing import PreprocessingStage
+    from pytasksyn.stages.expert import ExpertStage
+    from pytasksyn.stages.tutor import TutorStage
+    from pytasksyn.stages.student import StudentStage
+
     logger = get_logger()
     
     try:
         # Setup session directory if not provided
         if session_dir is None:
             session_dir = setup_session_directory(config)
-        
+
+        # Дисковый кэш LLM-ответов: повторные запуски на том же ревью-файле
+        # (и ретраи) получают идентичные ответы бесплатно
+        if config.get('cache', {}).get('enable_llm_cache', False):
+            from langchain_community.cache import SQLiteCache
+            from langchain.globals import set_llm_cache
+            cache_path = Path(__file__).parent.parent / ".llm_cache.sqlite"
+            set_llm_cache(SQLiteCache(database_path=str(cache_path)))
+            logger.info(f"Кэш LLM-ответов включён: {cache_path}")
+            # Кэшировать недетерминированные ответы — антипаттерн: хит
+            # навсегда фиксирует одну случайную выборку
+            sampled = [name for name, mc in config.get('models', {}).items()
+                       if mc.get('temperature') != 0]
+            if sampled:
+                logger.warning(f"Кэш LLM-ответов при temperature != 0 у моделей {sampled}: "
+                               f"повторные запуски будут возвращать одну и ту же выборку")
+
         # Create LLM instances
         preprocessor_llm = create_llm(config['models']['preprocessor'])
         expert_llm = create_llm(config['models']['expert'])
@@ -287,11 +347,29 @@ def run_pipeline(config=None, session_dir=None):
         student_stage = StudentStage(config, session_dir, student_llm) if student_llm else None
         
         # Execute pipeline
-        logger.stage_start("препроцессинг")
-        deduplicated_review_file = preprocessing_stage.run()
-        
-        logger.stage_start("эксперт")
-        expert_results = expert_stage.run(deduplicated_review_file)
+        if config.get('stages', {}).get('stream_expert', False):
+            # Перекрываем экспертные LLM-вызовы с препроцессингом: комментарии
+            # обрабатываются по мере дедупликации, а не после записи файла
+            import queue as queue_mod
+            from concurrent.futures import ThreadPoolExecutor
+
+            comment_queue = queue_mod.Queue()
+            logger.stage_start("препроцессинг + эксперт (потоково)")
+            with ThreadPoolExecutor(max_workers=1) as pool:
+                expert_future = pool.submit(expert_stage.run_streaming, comment_queue)
+                try:
+                    deduplicated_review_file, _ = preprocessing_stage.run(comment_queue)
+                finally:
+                    comment_queue.put(None)
+                expert_results = expert_future.result()
+        else:
+            logger.stage_start("препроцессинг")
+            deduplicated_review_file, deduplicated_comments = preprocessing_stage.run()
+
+            logger.stage_start("эксперт")
+            # Передаём уже разобранные комментарии — эксперту не нужно
+            # заново парсить только что записанный CSV
+            expert_results = expert_stage.run(deduplicated_review_file, deduplicated_comments)
         
         tutor_results = None
         if tutor_stage:
@@ -346,7 +424,9 @@ def generate_final_report(config, session_dir, expert_results, tutor_results, st
     """Generate final script report"""
     logger = get_logger()
     report = []
-    
+    total_comments = 0
+    accepted_comments = 0
+
     for comment_id, expert_result in expert_results.items():
         tutor_result = tutor_results.get(comment_id) if tutor_results else None
         student_result = student_results.get(comment_id) if student_results else None
@@ -383,18 +463,18 @@ def generate_final_report(config, session_dir, expert_results, tutor_results, st
         }
         
         report.append(report_entry)
-    
-    # Save report
+        total_comments += 1
+        accepted_comments += int(accepted)
+
+    # Save report — orjson serializes at C speed, ~порядок быстрее stdlib
     report_path = session_dir / "script_report.json"
-    with open(report_path, 'w') as f:
-        json.dump(report, f, indent=2)
+    report_path.write_bytes(orjson.dumps(report, option=orjson.OPT_INDENT_2))
     
     # Print summary
-    total_comments = len(report)
-    accepted_comments = sum(1 for entry in report if entry['accepted'])
     logger.summary(f"Всего обработано комментариев: {total_comments}")
     logger.summary(f"Принято микро-кейсов: {accepted_comments}")
-    logger.summary(f"Доля принятых: {accepted_comments/total_comments*100:.1f}%")
+    if total_comments:
+        logger.summary(f"Доля принятых: {accepted_comments/total_comments*100:.1f}%")
 
 if __name__ == "__main__":
     main()
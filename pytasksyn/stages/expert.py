@@ -6,12 +6,126 @@ import shutil
 import subprocess
 import tempfile
 import ast
+import asyncio
+import hashlib
+import json
+import re
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import Dict, Any
 from langchain.prompts import PromptTemplate
 from langchain_core.output_parsers import StrOutputParser
 
+from pytasksyn.utils.llm_stream import stream_until_fence
 from pytasksyn.utils.logging_utils import get_logger
+from pytasksyn.utils.pytest_worker import PytestWorkerPool
+
+
+_CODE_FENCE_RE = re.compile(r'```(?:python)?\n?(.*?)```', re.S)
+# Line heuristics for the fallback code cleaner: one anchored C-level match
+# replaces a tuple of startswith checks / substring scans per line
+_CODE_LINE_RE = re.compile(r'\s*(?:import |from |def |class |if |for |while |try:|except:|with |@)')
+_STATEMENT_RE = re.compile(r'=|return |assert |print\(|raise ')
+
+
+# Статичные инструкции идут первыми, переменные данные — последними:
+# byte-идентичный префикс позволяет провайдеру кэшировать его между вызовами
+DESCRIPTION_TEMPLATE = """
+        На основе комментария к коду и окружающего его контекста создай учебный микро-кейс по программированию, который поможет студенту понять и исправить ошибку.
+
+Требования к микро-кейсу:
+
+1. Показывает именно ту ошибку, о которой говорит комментарий.
+2. Объясняет основной принцип программирования, связанный с этой ошибкой.
+3. Решается в ограниченном объёме и логично.
+4. Может быть реализован в одном Python-файле.
+5. Содержит понятное описание задачи и требования.
+6. Не включай примеры кода или тесты — только описание задачи.
+
+
+Оформление к микро-кейсу:
+Название ошибки, на основе которого выделен микро кейсы должно писаться с верху и быть выделен жирным цветом.
+Далее должно быть описание микро кейсы.
+
+Данные:
+1. Файл: {file_path}
+2. Строка: {line_number}
+3. Комментарий: {comment}
+4. Контекст кода: {source_context}
+
+Описание микро-кейса:
+        """
+
+BATCH_DESCRIPTION_TEMPLATE = """Для КАЖДОГО из перечисленных комментариев к коду создай отдельный учебный микро-кейс по программированию, который поможет студенту понять и исправить ошибку.
+
+Требования к каждому микро-кейсу:
+
+1. Показывает именно ту ошибку, о которой говорит комментарий.
+2. Объясняет основной принцип программирования, связанный с этой ошибкой.
+3. Решается в ограниченном объёме и логично.
+4. Может быть реализован в одном Python-файле.
+5. Содержит понятное описание задачи и требования.
+6. Не включай примеры кода или тесты — только описание задачи.
+
+Оформление каждого микро-кейса:
+Название ошибки должно писаться сверху и быть выделено жирным цветом, далее — описание микро-кейса.
+
+Ответь СТРОГО JSON-массивом из {count} строк: i-й элемент — полный текст микро-кейса для i-го комментария. Никакого текста вне JSON.
+
+{comments_block}"""
+
+TEST_SUITE_TEMPLATE = """На основе этого микро-кейса создайте тестовый набор с использованием pytest с корректным Python-кодом.
+
+Требования:
+
+- Пишите ТОЛЬКО корректный Python-код, без объяснений
+- Начинайте с необходимых импортов (pytest и модули стандартной библиотеки)
+- Импортируйте функции из solution_expert с помощью: from solution_expert import function_name
+- Создавайте тестовые функции, проверяющие правильность работы решения
+- Используйте понятные имена тестовых функций, начинающиеся с test_
+- Включайте assertions для проверки ожидаемого поведения
+- НЕ определяйте тестируемые функции — только тестируйте их
+
+Пример формата:
+```
+import pytest
+from solution_expert import my_function
+
+def test_basic_functionality():
+    result = my_function(input_value)
+    assert result == expected_value
+
+def test_edge_cases():
+    # реализация теста
+    assert True
+```
+
+Микро-кейс:
+{microcase}
+
+Предоставьте полный корректный Python-код тестов, импортирующий функции из solution_expert."""
+
+SOLUTION_TEMPLATE = """На основе этого микро-кейса и набора тестов создайте эталонное решение.
+
+Требования:
+
+- Пишите ТОЛЬКО корректный Python-код, без объяснений и markdown
+- Включите все необходимые импорты в начале
+- Создавайте функции/классы по необходимости для решения микро-кейса
+- Убедитесь, что код проходит все предоставленные тесты
+- Следуйте лучшим практикам Python
+- НЕ включайте тестовые функции в решение
+- Включайте только функции реализации, которые будут импортироваться тестами
+
+Микро-кейс:
+{microcase}
+
+Набор тестов:
+{tests}
+
+Предоставьте полный корректный Python-код решения (только реализация, без тестов):"""
 
 
 class ExpertStage:
@@ -20,83 +134,341 @@ class ExpertStage:
         self.session_dir = session_dir
         self.expert_llm = expert_llm
         self.parser = StrOutputParser()
-    
-    def run(self, deduplicated_review_file: Path) -> Dict[int, Dict]:
-        """Run the expert stage to generate microcases for each comment"""
+        # Build chains once: template parsing is identical on every call
+        self._description_chain = PromptTemplate.from_template(DESCRIPTION_TEMPLATE) | expert_llm | self.parser
+        self._batch_description_chain = PromptTemplate.from_template(BATCH_DESCRIPTION_TEMPLATE) | expert_llm | self.parser
+        self._test_suite_chain = PromptTemplate.from_template(TEST_SUITE_TEMPLATE) | expert_llm | self.parser
+        self._solution_chain = PromptTemplate.from_template(SOLUTION_TEMPLATE) | expert_llm | self.parser
+        # Many comments reference the same file — read each file once per run
+        self._file_cache = {}
+        self._line_starts_cache = {}
+        # Bounded pool of warm pytest workers shared by verifying threads
+        self._pytest_workers = PytestWorkerPool()
+        # One long-lived executor serves all speculative solution tries —
+        # a per-attempt executor would churn threads on every comment
+        self._solution_executor = None
+        self._solution_executor_lock = threading.Lock()
+        # In-flight coalescing: concurrent identical prompts share one call
+        self._inflight = {}
+        self._inflight_lock = threading.Lock()
+
+    def run(self, deduplicated_review_file: Path, comments=None) -> Dict[int, Dict]:
+        """Run the expert stage to generate microcases for each comment.
+
+        comments, when provided by the preprocessing stage, skips
+        re-parsing the CSV it just wrote; otherwise rows are loaded
+        lazily from deduplicated_review_file.
+        """
         logger = get_logger()
         logger.processing("Starting expert stage")
-        
-        # Load deduplicated comments
-        comments = self._load_comments(deduplicated_review_file)
-        logger.info(f"Processing {len(comments)} deduplicated comments")
-        
+
+        if comments is None:
+            # Load deduplicated comments lazily — rows are parsed as they
+            # are scheduled instead of materializing the whole CSV up front
+            comments = self._load_comments(deduplicated_review_file)
+        else:
+            # Normalize numeric columns the same way _load_comments does,
+            # without mutating the preprocessing stage's dicts
+            comments = ({**c, 'comment_id': int(c['comment_id']),
+                         'line_number': int(c['line_number'])} for c in comments)
+
         # Embed comments into source files first
         self._embed_comments(deduplicated_review_file)
-        
-        # Process each comment
-        results = {}
-        for comment in comments:
+
+        # Row-marshal several comments into one LLM call where configured:
+        # N description calls collapse to ceil(N / batch_size), which also
+        # helps under provider RPM caps. Batching needs the full set up
+        # front, so only this path materializes the generator.
+        batch_size = self.config.get('expert', {}).get('batch_size', 1)
+        precomputed = {}
+        if batch_size > 1:
+            comments = list(comments)
+            precomputed = self._precompute_descriptions(comments, batch_size)
+
+        # Process comments concurrently: each comment is independent and
+        # spends most of its time waiting on LLM round-trips, so a bounded
+        # gather collapses wall time roughly linearly in concurrency
+        max_inflight = self.config.get('concurrency', {}).get('expert', 4)
+        sem = asyncio.Semaphore(max_inflight)
+
+        async def _run_one(comment):
             comment_id = int(comment['comment_id'])
-            logger.processing(f"Processing comment {comment_id}: {comment['file_path']}:{comment['line_number']}")
-            
-            result = self._process_comment(comment)
-            results[comment_id] = result
-            
+            async with sem:
+                logger.processing(f"Processing comment {comment_id}: {comment['file_path']}:{comment['line_number']}")
+                result = await asyncio.to_thread(self._process_comment, comment, precomputed.get(comment_id))
             if result['success']:
                 logger.success(f"Generated microcase for comment {comment_id} after {result['attempts']} attempts")
             else:
                 logger.error(f"Failed to generate valid microcase for comment {comment_id} after {result['attempts']} attempts")
-        
+            return comment_id, result
+
+        async def _run_all():
+            tasks = [_run_one(c) for c in comments]
+            logger.info(f"Processing {len(tasks)} deduplicated comments")
+            return await asyncio.gather(*tasks)
+
+        try:
+            results = dict(asyncio.run(_run_all()))
+        finally:
+            self._shutdown_solution_executor()
+            self._pytest_workers.close_all()
+
         # Print summary
         successful = sum(1 for r in results.values() if r['success'])
         total = len(results)
         logger.stage_complete("expert", {"successful": successful, "total": total})
-        
+
         return results
     
+    def run_streaming(self, comment_queue) -> Dict[int, Dict]:
+        """Run the expert stage on comments streamed from preprocessing.
+
+        Consumes deduplicated comments from comment_queue (terminated by
+        None) so expert LLM calls overlap with preprocessing instead of
+        waiting for the full deduplicated file. Comment embedding needs the
+        complete review file, so source context falls back to the original
+        project files here.
+        """
+        logger = get_logger()
+        logger.processing("Starting expert stage (streaming)")
+
+        max_inflight = self.config.get('concurrency', {}).get('expert', 4)
+
+        async def _run_all():
+            sem = asyncio.Semaphore(max_inflight)
+
+            async def _run_one(comment):
+                comment_id = int(comment['comment_id'])
+                async with sem:
+                    logger.processing(f"Processing comment {comment_id}: {comment['file_path']}:{comment['line_number']}")
+                    result = await asyncio.to_thread(self._process_comment, comment)
+                if result['success']:
+                    logger.success(f"Generated microcase for comment {comment_id} after {result['attempts']} attempts")
+                else:
+                    logger.error(f"Failed to generate valid microcase for comment {comment_id} after {result['attempts']} attempts")
+                return comment_id, result
+
+            tasks = []
+            while True:
+                comment = await asyncio.to_thread(comment_queue.get)
+                if comment is None:
+                    break
+                tasks.append(asyncio.create_task(_run_one(comment)))
+            return await asyncio.gather(*tasks)
+
+        try:
+            results = dict(asyncio.run(_run_all()))
+        finally:
+            self._shutdown_solution_executor()
+            self._pytest_workers.close_all()
+
+        successful = sum(1 for r in results.values() if r['success'])
+        logger.stage_complete("expert", {"successful": successful, "total": len(results)})
+
+        return results
+
     def _load_comments(self, review_file: Path):
-        """Load comments from CSV file"""
-        comments = []
-        with open(review_file, 'r', encoding='utf-8') as f:
-            reader = csv.DictReader(f)
-            comments = list(reader)
-        return comments
+        """Yield comments from CSV file one row at a time.
+
+        Uses the raw C-level csv.reader (DictReader adds per-row Python
+        overhead) and parses the numeric columns once so downstream int()
+        casts are no-ops. Streaming keeps peak memory at one row instead
+        of the whole file for callers that don't need the full list.
+        """
+        with open(review_file, 'r', encoding='utf-8', newline='') as f:
+            reader = csv.reader(f)
+            header = next(reader, None)
+            if not header:
+                return
+            for row in reader:
+                comment = dict(zip(header, row))
+                comment['comment_id'] = int(comment['comment_id'])
+                comment['line_number'] = int(comment['line_number'])
+                yield comment
     
     def _embed_comments(self, review_file: Path):
-        """Run embed_comments.py to create embedded source files"""
+        """Embed review comments into source file copies, in-process"""
         logger = get_logger()
         logger.processing("Embedding comments into source files")
-        
+
         # Paths
         project_root = Path(self.config['paths']['student_project'])
         embedded_dir = self.session_dir / "embedded_source"
-        embed_script = Path(__file__).parent.parent / "utils" / "embed_comments.py"
-        
+
         try:
-            # Run embed_comments.py
-            result = subprocess.run([
-                sys.executable, str(embed_script),
-                "--review-file", str(review_file),
-                "--project-root", str(project_root),
-                "--output-dir", str(embedded_dir)
-            ], capture_output=True, text=True, check=True)
-            
+            # Direct call — no interpreter startup or import cost per session
+            from pytasksyn.utils.embed_comments import embed_comments_into_sources
+            returncode = embed_comments_into_sources(review_file, project_root, embedded_dir)
+            if returncode != 0:
+                raise RuntimeError(f"embed_comments returned {returncode}")
+
             logger.success(f"Embedded source files created in: {embedded_dir}")
-            
-        except subprocess.CalledProcessError as e:
+
+        except Exception as e:
             logger.warning(f"Failed to embed comments: {e}")
             # Log detailed error to file
-            logger.log('error', f"Embed comments failed - stdout: {e.stdout}, stderr: {e.stderr}", 'main', console_emoji=False)
-            logger.log('debug', f"Embed script command: {[sys.executable, str(embed_script), '--review-file', str(review_file), '--project-root', str(project_root), '--output-dir', str(embedded_dir)]}", 'main', console_emoji=False)
+            logger.log('error', f"Embed comments failed: {e}", 'main', console_emoji=False)
             # Continue without embedded files
     
-    def _process_comment(self, comment: Dict) -> Dict:
+    def _precompute_descriptions(self, comments, batch_size: int) -> Dict[int, str]:
+        """Generate microcase descriptions in batches of batch_size comments.
+
+        Returns comment_id → description for batches that parsed cleanly;
+        comments missing from the result fall back to per-comment calls.
+        """
+        logger = get_logger()
+        precomputed: Dict[int, str] = {}
+        for start in range(0, len(comments), batch_size):
+            batch = comments[start:start + batch_size]
+            if len(batch) == 1:
+                continue  # a single comment gains nothing from marshaling
+            try:
+                precomputed.update(self._generate_microcase_descriptions_batch(batch))
+            except Exception as e:
+                logger.warning(f"Batched microcase generation failed for comments "
+                               f"{[c['comment_id'] for c in batch]}, falling back to per-comment calls: {e}")
+        return precomputed
+
+    def _generate_microcase_descriptions_batch(self, batch) -> Dict[int, str]:
+        """Generate descriptions for several comments with one LLM call"""
+        blocks = []
+        for i, comment in enumerate(batch, 1):
+            source_context = self._load_source_context(comment)
+            blocks.append(
+                f"### Комментарий {i}\n"
+                f"Файл: {comment['file_path']}\n"
+                f"Строка: {comment['line_number']}\n"
+                f"Комментарий: {comment['comment']}\n"
+                f"Контекст кода:\n{source_context}"
+            )
+
+        response = self._batch_description_chain.invoke({
+            "comments_block": "\n\n".join(blocks),
+            "count": len(batch)
+        })
+
+        # Tolerate markdown fences around the array
+        text = response.strip()
+        array_start, array_end = text.find('['), text.rfind(']')
+        if array_start == -1 or array_end == -1:
+            raise ValueError("No JSON array in batched response")
+        descriptions = json.loads(text[array_start:array_end + 1])
+        if not isinstance(descriptions, list) or len(descriptions) != len(batch):
+            raise ValueError(f"Expected {len(batch)} descriptions, got {descriptions if not isinstance(descriptions, list) else len(descriptions)}")
+
+        return {
+            int(comment['comment_id']): str(description).strip()
+            for comment, description in zip(batch, descriptions)
+            if str(description).strip()
+        }
+
+    def _coalesced_invoke(self, chain, inputs: Dict) -> str:
+        """Invoke a chain, sharing the result with concurrent identical calls.
+
+        Comments on the same file section produce identical prompts; the
+        first caller becomes the leader and the rest wait for its result
+        instead of issuing duplicate LLM requests.
+        """
+        key = (id(chain), hashlib.sha256(repr(sorted(inputs.items())).encode('utf-8')).hexdigest())
+        with self._inflight_lock:
+            entry = self._inflight.get(key)
+            leader = entry is None
+            if leader:
+                entry = {'event': threading.Event(), 'result': None, 'error': None}
+                self._inflight[key] = entry
+        if not leader:
+            entry['event'].wait()
+            if entry['error'] is not None:
+                raise entry['error']
+            return entry['result']
+        try:
+            entry['result'] = chain.invoke(inputs)
+            return entry['result']
+        except Exception as e:
+            entry['error'] = e
+            raise
+        finally:
+            with self._inflight_lock:
+                self._inflight.pop(key, None)
+            entry['event'].set()
+
+    def _get_solution_executor(self) -> ThreadPoolExecutor:
+        """Lazily create the shared speculative-solution executor.
+
+        Sized for the worst case: every in-flight comment running all its
+        solution tries at once.
+        """
+        with self._solution_executor_lock:
+            if self._solution_executor is None:
+                max_inflight = self.config.get('concurrency', {}).get('expert', 4)
+                tries = self.config.get('expert', {}).get('max_solution_attempts', 3)
+                self._solution_executor = ThreadPoolExecutor(
+                    max_workers=max(1, max_inflight * tries))
+            return self._solution_executor
+
+    def _shutdown_solution_executor(self):
+        with self._solution_executor_lock:
+            executor, self._solution_executor = self._solution_executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+    @staticmethod
+    def _prepare_comment_layout(comment_dir: Path, max_attempts: int):
+        """Create all attempt directories for a comment in one pass"""
+        for attempt in range(max_attempts):
+            (comment_dir / "expert_output" / f"attempt_{attempt}" / "tests").mkdir(
+                parents=True, exist_ok=True)
+
+    def _cache_dir(self):
+        """Cross-session expert cache directory, or None when disabled"""
+        cache_dir = self.config.get('cache', {}).get('expert_results_dir')
+        return Path(cache_dir) if cache_dir else None
+
+    def _cache_key(self, comment: Dict) -> str:
+        """Stable key for a comment's expert artifacts, tied to the model"""
+        model_name = self.config.get('models', {}).get('expert', {}).get('model_name', '')
+        raw = f"{comment['file_path']}:{comment['line_number']}:{comment['comment']}:{model_name}"
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+    def _load_cached_result(self, cache_dir: Path, key: str, comment_dir: Path, result: Dict):
+        """Copy a cached successful attempt into this session, if present"""
+        entry = cache_dir / key
+        if not entry.is_dir():
+            return None
+        try:
+            attempt_dir = comment_dir / "expert_output" / "attempt_cached"
+            if attempt_dir.exists():
+                shutil.rmtree(attempt_dir)
+            attempt_dir.parent.mkdir(parents=True, exist_ok=True)
+            shutil.copytree(entry, attempt_dir)
+            result['success'] = True
+            result['successful_attempt_dir'] = str(attempt_dir)
+            return result
+        except Exception as e:
+            get_logger().warning(f"Failed to load expert cache entry {key}: {e}")
+            return None
+
+    def _store_cached_result(self, cache_dir: Path, key: str, attempt_dir: Path):
+        """Atomically store a successful attempt's artifacts in the cache"""
+        try:
+            entry = cache_dir / key
+            if entry.exists():
+                return
+            cache_dir.mkdir(parents=True, exist_ok=True)
+            tmp = cache_dir / f".{key}.tmp"
+            if tmp.exists():
+                shutil.rmtree(tmp)
+            shutil.copytree(attempt_dir, tmp)
+            os.replace(tmp, entry)
+        except Exception as e:
+            get_logger().warning(f"Failed to store expert cache entry {key}: {e}")
+
+    def _process_comment(self, comment: Dict, precomputed_description: str = None) -> Dict:
         """Process a single comment through the expert stage"""
         logger = get_logger()
         comment_id = int(comment['comment_id'])
         comment_dir = self.session_dir / f"comment_{comment_id}"
-        comment_dir.mkdir(exist_ok=True)
-        
+
         result = {
             'comment_id': comment_id,
             'source_file_path': comment['file_path'],
@@ -106,21 +478,45 @@ class ExpertStage:
             'duration': {'total': 0, 'avg': 0, 'attempts': []},
             'successful_attempt_dir': None
         }
-        
+
         max_attempts = self.config['expert']['max_attempts']
-        
+
+        # Lay out every attempt dir for this comment in one pass instead of
+        # sprinkling mkdir calls through the attempt loop
+        self._prepare_comment_layout(comment_dir, max_attempts)
+
+        # Cross-session cache: identical comment + model means identical work
+        cache_dir = self._cache_dir()
+        cache_key = self._cache_key(comment) if cache_dir else None
+        if cache_dir:
+            cached = self._load_cached_result(cache_dir, cache_key, comment_dir, result)
+            if cached is not None:
+                logger.info(f"Comment {comment_id}: reusing cached expert artifacts")
+                return cached
+
+        # Source context is identical for every attempt on this comment —
+        # load and limit it once instead of per retry
+        source_context = None if precomputed_description else self._load_source_context(comment)
+
         for attempt in range(max_attempts):
             start_time = time.time()
-            
+
             attempt_dir = comment_dir / "expert_output" / f"attempt_{attempt}"
-            attempt_dir.mkdir(parents=True, exist_ok=True)
-            
+
             # Create attempt logger for detailed logging
             attempt_logger = logger.create_attempt_logger(attempt_dir, attempt)
-            
+
             logger.attempt_log(attempt + 1, max_attempts, f"Processing comment {comment_id}")
-            
-            success = self._generate_microcase_attempt(comment, attempt_dir, attempt_logger)
+
+            # The batched description (if any) is only valid for the first
+            # attempt; retries regenerate it individually
+            if attempt == 1 and precomputed_description:
+                source_context = self._load_source_context(comment)
+            success = self._generate_microcase_attempt(
+                comment, attempt_dir, attempt_logger,
+                precomputed_description if attempt == 0 else None,
+                source_context
+            )
             
             end_time = time.time()
             duration = int(end_time - start_time)
@@ -131,6 +527,8 @@ class ExpertStage:
                 result['success'] = True
                 result['successful_attempt_dir'] = str(attempt_dir)
                 logger.success(f"Comment {comment_id} succeeded on attempt {attempt + 1}")
+                if cache_dir:
+                    self._store_cached_result(cache_dir, cache_key, attempt_dir)
                 break
             else:
                 logger.warning(f"Comment {comment_id} attempt {attempt + 1} failed")
@@ -142,15 +540,19 @@ class ExpertStage:
         
         return result
     
-    def _generate_microcase_attempt(self, comment: Dict, attempt_dir: Path, attempt_logger) -> bool:
+    def _generate_microcase_attempt(self, comment: Dict, attempt_dir: Path, attempt_logger,
+                                    precomputed_description: str = None,
+                                    source_context: str = None) -> bool:
         """Generate microcase, tests, and solution for one attempt"""
         try:
-            # Load source context
-            source_context = self._load_source_context(comment)
-            
-            # Generate microcase description
+            # Generate microcase description (unless it came from a batched call)
             attempt_logger.log_generation("microcase description", "starting")
-            microcase = self._generate_microcase_description(comment, source_context)
+            if precomputed_description:
+                microcase = precomputed_description
+            else:
+                if source_context is None:
+                    source_context = self._load_source_context(comment)
+                microcase = self._generate_microcase_description(comment, source_context)
             if not microcase:
                 attempt_logger.log_generation("microcase description", "failed", "Empty response from LLM")
                 return False
@@ -158,8 +560,7 @@ class ExpertStage:
             attempt_logger.log_generation("microcase description", "success")
             
             # Save microcase
-            with open(attempt_dir / "microcase.txt", 'w', encoding='utf-8') as f:
-                f.write(microcase)
+            (attempt_dir / "microcase.txt").write_text(microcase, encoding='utf-8')
             
             # Generate test suite
             attempt_logger.log_generation("test suite", "starting")
@@ -170,38 +571,71 @@ class ExpertStage:
             
             attempt_logger.log_generation("test suite", "success")
             
-            # Save tests
+            # Save tests (dir pre-created by _prepare_comment_layout)
             tests_dir = attempt_dir / "tests"
-            tests_dir.mkdir(exist_ok=True)
-            with open(tests_dir / "test_microcase.py", 'w', encoding='utf-8') as f:
-                f.write(tests)
+            (tests_dir / "test_microcase.py").write_text(tests, encoding='utf-8')
             
-            # Multiple solution generation attempts
+            # Speculative solution sampling: retries exist only because any
+            # single sample may fail, so issue all tries at once and accept
+            # the first one that passes instead of paying serial round-trips
             solution_max_attempts = self.config.get('expert', {}).get('max_solution_attempts', 3)
+            stop = threading.Event()
+            # Low temperature often regenerates the exact same solution —
+            # remember verdicts per solution hash so identical text never
+            # pays for a second pytest run
+            verified_by_hash = {}
+            verified_lock = threading.Lock()
 
-            last_solution_text = None
-            for sol_try in range(solution_max_attempts):
+            def _try_solution(sol_try):
                 attempt_logger.log_generation("expert solution", f"attempt {sol_try + 1}/{solution_max_attempts}")
                 solution = self._generate_expert_solution(microcase, tests)
                 if not solution:
                     attempt_logger.log_generation("expert solution", f"attempt {sol_try + 1} failed", "Empty response from LLM")
-                    continue
+                    return sol_try, None, False
+                if stop.is_set():
+                    # Another try already passed — skip the pytest run
+                    return sol_try, solution, False
+                solution_hash = hashlib.sha1(solution.encode('utf-8')).hexdigest()
+                with verified_lock:
+                    if solution_hash in verified_by_hash:
+                        attempt_logger.log_generation("expert solution",
+                                                      f"attempt {sol_try + 1} identical to an earlier try, reusing verdict")
+                        return sol_try, solution, verified_by_hash[solution_hash]
+                # Cheap pre-check: skip the pytest run when the solution can't
+                # even satisfy the test file's imports
+                if not self._imports_satisfied(solution, tests):
+                    attempt_logger.log_generation("expert solution",
+                                                  f"attempt {sol_try + 1} failed pre-check (syntax/missing names)")
+                    return sol_try, solution, False
+                # Each try verifies in its own dir to avoid file collisions
+                try_dir = attempt_dir / f"solution_try_{sol_try}"
+                try_dir.mkdir(exist_ok=True)
+                (try_dir / "solution_expert.py").write_text(solution, encoding='utf-8')
+                passed, test_stdout, test_stderr = self._verify_solution_detailed(
+                    attempt_dir, "solution_expert.py", solution_dir=try_dir)
+                with verified_lock:
+                    verified_by_hash[solution_hash] = passed
+                attempt_logger.log_test_run(f"solution_try_{sol_try}/solution_expert.py",
+                                            test_stdout, test_stderr, 0 if passed else 1)
+                if passed:
+                    stop.set()
+                else:
+                    attempt_logger.log_generation("expert solution", f"attempt {sol_try + 1} failed tests")
+                return sol_try, solution, passed
 
-                last_solution_text = solution
-                # Save (overwrite) solution file for this try
-                solution_path = attempt_dir / "solution_expert.py"
-                with open(solution_path, 'w', encoding='utf-8') as f:
-                    f.write(solution)
+            pool = self._get_solution_executor()
+            outcomes = [f.result() for f in
+                        [pool.submit(_try_solution, i) for i in range(solution_max_attempts)]]
 
-                # Verify solution passes tests
-                passed, test_stdout, test_stderr = self._verify_solution_detailed(attempt_dir, "solution_expert.py")
-                attempt_logger.log_test_run("solution_expert.py", test_stdout, test_stderr, 0 if passed else 1)
-                
+            last_solution_text = None
+            for sol_try, solution, passed in outcomes:
+                if solution:
+                    last_solution_text = solution
                 if passed:
+                    # Keep the winning solution where downstream stages expect it
+                    (attempt_dir / "solution_expert.py").write_text(solution, encoding='utf-8')
                     attempt_logger.log_generation("expert solution", f"success on attempt {sol_try + 1}")
                     return True
-                else:
-                    attempt_logger.log_generation("expert solution", f"attempt {sol_try + 1} failed tests")
 
             # If we reach here — all solution generation attempts failed
             attempt_logger.log_generation("expert solution", "all attempts failed")
@@ -215,96 +649,94 @@ class ExpertStage:
             return False
 
     
+    def _read_file_cached(self, path: Path):
+        """Read a file once per run; returns None if it can't be read.
+
+        EAFP: a missing file is an expected fallback case (embedded copy
+        may not exist), so it's handled silently without a stat pre-check.
+        """
+        key = str(path)
+        if key not in self._file_cache:
+            try:
+                self._file_cache[key] = path.read_text(encoding='utf-8')
+            except FileNotFoundError:
+                self._file_cache[key] = None
+            except Exception as e:
+                get_logger().warning(f"Could not read file {path}: {e}")
+                self._file_cache[key] = None
+        return self._file_cache[key]
+
     def _load_source_context(self, comment: Dict) -> str:
         """Load source context with embedded comments and apply limits"""
         # Try to load embedded file first
         embedded_dir = self.session_dir / "embedded_source"
         embedded_file = embedded_dir / comment['file_path']
-        
-        content = None
-        if embedded_file.exists():
-            try:
-                with open(embedded_file, 'r', encoding='utf-8') as f:
-                    content = f.read()
-            except Exception as e:
-                print(f"      Warning: Could not read embedded file: {e}")
-        
+
+        # EAFP: read directly and fall back on None instead of paying an
+        # extra stat with exists() when the file is usually there
+        content = self._read_file_cached(embedded_file)
+
         # Fallback to original file
         if content is None:
             original_file = Path(self.config['paths']['student_project']) / comment['file_path']
-            try:
-                with open(original_file, 'r', encoding='utf-8') as f:
-                    content = f.read()
-            except Exception as e:
+            content = self._read_file_cached(original_file)
+            if content is None:
                 logger = get_logger()
-                logger.warning(f"Could not read original file {original_file}: {e}")
+                logger.warning(f"Could not read original file {original_file}")
                 # Create minimal content with enough lines to handle the comment
                 target_line = int(comment['line_number'])
                 lines = [f"// File: {comment['file_path']}"]
                 lines.extend([f"// Line {i} - could not load original content" for i in range(2, target_line + 5)])
                 content = "\\n".join(lines)
-        
+
         # Apply context limits
         return self._apply_context_limits(content, comment)
     
+    def _line_starts(self, content: str):
+        """Offsets of each line start in content, cached per file content"""
+        starts = self._line_starts_cache.get(content)
+        if starts is None:
+            starts = [0]
+            find = content.find
+            i = find('\n')
+            while i != -1:
+                starts.append(i + 1)
+                i = find('\n', i + 1)
+            # Sentinel so slicing line N uses starts[N+1] - 1 uniformly
+            starts.append(len(content) + 1)
+            self._line_starts_cache[content] = starts
+        return starts
+
     def _apply_context_limits(self, content: str, comment: Dict) -> str:
         """Apply context limits based on configuration"""
         max_symbols = self.config['expert']['context_max_symbols']
         comment_margin = self.config['expert']['context_comment_margin']
-        
+
         # If content is within limits, return as-is
         if len(content) <= max_symbols:
             return content
-        
-        lines = content.split('\\n')
+
         comment_line = int(comment['line_number']) - 1  # Convert to 0-based
-        
-        # If comment_margin is specified and not None, extract margin around comment
+
+        # If comment_margin is specified and not None, extract margin around
+        # comment with a single slice over precomputed line offsets — no
+        # per-call split/join allocations
         if comment_margin is not None:
-            start_line = max(0, comment_line - comment_margin)
-            end_line = min(len(lines), comment_line + comment_margin + 1)
-            limited_content = '\\n'.join(lines[start_line:end_line])
-            
-            if len(limited_content) <= max_symbols:
-                return limited_content
-        
+            starts = self._line_starts(content)
+            num_lines = len(starts) - 1
+            start_line = max(0, min(comment_line - comment_margin, num_lines))
+            end_line = min(num_lines, comment_line + comment_margin + 1)
+            if start_line < end_line:
+                limited_content = content[starts[start_line]:starts[end_line] - 1]
+                if len(limited_content) <= max_symbols:
+                    return limited_content
+
         # Fallback: truncate to max_symbols
-        return content[:max_symbols] + "\\n\\n... [Content truncated due to size limits] ..."
+        return content[:max_symbols] + "\n\n... [Content truncated due to size limits] ..."
     
     def _generate_microcase_description(self, comment: Dict, source_context: str) -> str:
         """Generate microcase description using LLM"""
-        prompt_template = """        
-        На основе комментария к коду и окружающего его контекста создай учебный микро-кейс по программированию, который поможет студенту понять и исправить ошибку.
-Данные:
-1. Файл: {file_path}
-2. Строка: {line_number}
-3. Комментарий: {comment}
-4. Контекст кода: {source_context}
-
-Требования к микро-кейсу:
-
-1. Показывает именно ту ошибку, о которой говорит комментарий.
-2. Объясняет основной принцип программирования, связанный с этой ошибкой.
-3. Решается в ограниченном объёме и логично.
-4. Может быть реализован в одном Python-файле.
-5. Содержит понятное описание задачи и требования.
-6. Не включай примеры кода или тесты — только описание задачи.
-
-
-Оформление к микро-кейсу:
-Название ошибки, на основе которого выделен микро кейсы должно писаться с верху и быть выделен жирным цветом.
-Далее должно быть описание микро кейсы.
-
-Описание микро-кейса:
-        """
-        
-        prompt = PromptTemplate(
-            template=prompt_template,
-            input_variables=["file_path", "line_number", "comment", "source_context"]
-        )
-        
-        chain = prompt | self.expert_llm | self.parser
-        response = chain.invoke({
+        response = self._coalesced_invoke(self._description_chain, {
             "file_path": comment['file_path'],
             "line_number": comment['line_number'],
             "comment": comment['comment'],
@@ -315,80 +747,17 @@ class ExpertStage:
     
     def _generate_test_suite(self, microcase: str) -> str:
         """Generate pytest test suite for the microcase"""
-        prompt_template = """На основе этого микро-кейса создайте тестовый набор с использованием pytest с корректным Python-кодом.
-
-Микро-кейс:
-{microcase}
+        response = self._coalesced_invoke(self._test_suite_chain, {"microcase": microcase})
 
-Требования:
-
-- Пишите ТОЛЬКО корректный Python-код, без объяснений
-- Начинайте с необходимых импортов (pytest и модули стандартной библиотеки)
-- Импортируйте функции из solution_expert с помощью: from solution_expert import function_name
-- Создавайте тестовые функции, проверяющие правильность работы решения
-- Используйте понятные имена тестовых функций, начинающиеся с test_
-- Включайте assertions для проверки ожидаемого поведения
-- НЕ определяйте тестируемые функции — только тестируйте их
-
-Пример формата:
-```
-import pytest
-from solution_expert import my_function
-
-def test_basic_functionality():
-    result = my_function(input_value)
-    assert result == expected_value
-
-def test_edge_cases():
-    # реализация теста
-    assert True
-```
-
-Предоставьте полный корректный Python-код тестов, импортирующий функции из solution_expert."""
-        
-        prompt = PromptTemplate(
-            template=prompt_template,
-            input_variables=["microcase"]
-        )
-        
-        chain = prompt | self.expert_llm | self.parser
-        response = chain.invoke({"microcase": microcase})
-        
         return self._clean_test_code(response)
     
     def _generate_expert_solution(self, microcase: str, tests: str) -> str:
         """Generate expert solution for the microcase"""
-        prompt_template = """На основе этого микро-кейса и набора тестов создайте эталонное решение.
-
-Микро-кейс:
-{microcase}
-
-Набор тестов:
-{tests}
-
-Требования:
-
-- Пишите ТОЛЬКО корректный Python-код, без объяснений и markdown
-- Включите все необходимые импорты в начале
-- Создавайте функции/классы по необходимости для решения микро-кейса
-- Убедитесь, что код проходит все предоставленные тесты
-- Следуйте лучшим практикам Python
-- НЕ включайте тестовые функции в решение
-- Включайте только функции реализации, которые будут импортироваться тестами
+        # Stream and stop once the code fence closes: the trailing prose
+        # costs tokens and tail latency but never contains code
+        response = stream_until_fence(self._solution_chain,
+                                      {"microcase": microcase, "tests": tests})
 
-Предоставьте полный корректный Python-код решения (только реализация, без тестов):"""
-        
-        prompt = PromptTemplate(
-            template=prompt_template,
-            input_variables=["microcase", "tests"]
-        )
-        
-        chain = prompt | self.expert_llm | self.parser
-        response = chain.invoke({
-            "microcase": microcase,
-            "tests": tests
-        })
-        
         return self._clean_solution_code(response)
     
     def _clean_test_code(self, code_text: str) -> str:
@@ -401,6 +770,20 @@ def test_edge_cases():
     
     def _clean_python_code(self, code_text: str, keep_tests: bool = True) -> str:
         """Clean LLM output to extract only valid Python code"""
+        # Fast path: strip markdown fences, parse once, filter structurally.
+        # One C-level parse replaces the per-line heuristic dispatch below.
+        fence_match = _CODE_FENCE_RE.search(code_text)
+        stripped = (fence_match.group(1) if fence_match else code_text).strip()
+        if stripped:
+            try:
+                tree = ast.parse(stripped)
+                if not keep_tests:
+                    tree.body = [n for n in tree.body
+                                 if not (isinstance(n, ast.FunctionDef) and n.name.startswith('test_'))]
+                return ast.unparse(tree)
+            except SyntaxError:
+                pass  # mixed prose/code — fall back to the line heuristic
+
         lines = code_text.strip().split('\n')
         cleaned_lines = []
         in_code_block = False
@@ -426,11 +809,11 @@ def test_edge_cases():
                 continue
             
             # If we're in a code block or line looks like Python code, keep it
-            if in_code_block or line.strip().startswith(('import ', 'from ', 'def ', 'class ', 'if ', 'for ', 'while ', 'try:', 'except:', 'with ', '@')) or line.strip() == '' or line.startswith('    ') or line.startswith('\t'):
+            if in_code_block or _CODE_LINE_RE.match(line) or line.strip() == '' or line.startswith('    ') or line.startswith('\t'):
                 if keep_tests or not skip_test_functions:
                     cleaned_lines.append(line)
             # Keep lines that look like Python statements
-            elif any(keyword in line for keyword in ['=', 'return ', 'assert ', 'print(', 'raise ']):
+            elif _STATEMENT_RE.search(line):
                 if keep_tests or not skip_test_functions:
                     cleaned_lines.append(line)
             # Keep comments
@@ -452,32 +835,74 @@ def test_edge_cases():
         
         return cleaned_code
     
+    @staticmethod
+    def _imports_satisfied(solution: str, tests: str) -> bool:
+        """Pre-pytest check: solution parses and exports every name the
+        tests import from solution_expert — otherwise pytest is a foregone
+        failure that isn't worth its startup cost."""
+        try:
+            solution_tree = ast.parse(solution)
+            tests_tree = ast.parse(tests)
+        except SyntaxError:
+            return False
+        imported = set()
+        for node in ast.walk(tests_tree):
+            if isinstance(node, ast.ImportFrom) and node.module == 'solution_expert':
+                imported.update(alias.name for alias in node.names)
+        if not imported or '*' in imported:
+            return True
+        exported = set()
+        for node in solution_tree.body:
+            if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+                exported.add(node.name)
+            elif isinstance(node, ast.Assign):
+                exported.update(t.id for t in node.targets if isinstance(t, ast.Name))
+            elif isinstance(node, ast.AnnAssign) and isinstance(node.target, ast.Name):
+                exported.add(node.target.id)
+        return imported <= exported
+
     def _verify_solution(self, attempt_dir: Path, solution_filename: str) -> bool:
         """Verify that the solution passes all tests"""
         passed, _, _ = self._verify_solution_detailed(attempt_dir, solution_filename)
         return passed
     
-    def _verify_solution_detailed(self, attempt_dir: Path, solution_filename: str) -> tuple[bool, str, str]:
-        """Verify that the solution passes all tests and return detailed output"""
+    def _verify_solution_detailed(self, attempt_dir: Path, solution_filename: str,
+                                  solution_dir: Path = None) -> tuple[bool, str, str]:
+        """Verify that the solution passes all tests and return detailed output.
+
+        solution_dir lets concurrent tries keep their candidate solutions in
+        separate directories; defaults to attempt_dir.
+        """
         try:
-            # Ensure pytest can import solution module from attempt_dir
-            solution_file = attempt_dir / solution_filename
-            tests_dir = attempt_dir / "tests"
-            
-            if not solution_file.exists() or not tests_dir.exists():
-                return False, "", "Solution or tests directory not found"
+            # Ensure pytest can import solution module from its directory.
+            # No exists() pre-checks: the layout is pre-created per comment
+            # and a missing file surfaces as a pytest collection error anyway
+            solution_dir = solution_dir or attempt_dir
+
+            # Prefer the persistent worker — no interpreter startup per verify
+            try:
+                rc, out, err = self._pytest_workers.run(attempt_dir, "tests/", [solution_dir])
+                return rc == 0, out, err
+            except Exception:
+                pass  # worker died or never started; fall back to a one-shot run
 
             env = os.environ.copy()
-            # Prepend attempt_dir to PYTHONPATH to import solution module
-            env["PYTHONPATH"] = f"{str(attempt_dir)}{os.pathsep}{env.get('PYTHONPATH', '')}"
+            # Prepend solution dir to PYTHONPATH to import solution module
+            env["PYTHONPATH"] = f"{str(solution_dir)}{os.pathsep}{env.get('PYTHONPATH', '')}"
 
-            # Run pytest directly against tests in attempt_dir
-            result = subprocess.run([
+            # Run pytest directly against tests in attempt_dir. Stream the
+            # output instead of buffering it all: we only ever look at the
+            # tail on failure, so a bounded deque keeps memory flat even
+            # for very verbose runs
+            proc = subprocess.Popen([
                 sys.executable, "-m", "pytest", "-v", "tests/"
-            ], cwd=attempt_dir, env=env, capture_output=True, text=True)
+            ], cwd=attempt_dir, env=env, stdout=subprocess.PIPE,
+               stderr=subprocess.STDOUT, text=True)
+            tail = deque(proc.stdout, maxlen=500)
+            proc.stdout.close()
+            rc = proc.wait()
 
-            success = result.returncode == 0
-            return success, result.stdout, result.stderr
+            return rc == 0, "".join(tail), ""
                 
         except Exception as e:
             return False, "", f"Error verifying solution: {e}"
\ No newline at end of file
@@ -1,5 +1,6 @@
 import os
 import csv
+import json
 import time
 from pathlib import Path
 from langchain.prompts import PromptTemplate
@@ -8,35 +9,77 @@ from langchain_core.output_parsers import StrOutputParser
 from pytasksyn.utils.logging_utils import get_logger
 
 
+# Static instructions first, per-file data last: a byte-identical prefix
+# lets providers cache the instruction tokens across calls
+DEDUP_TEMPLATE = """Given a file's code review comments, identify which comments are unique and should be kept.
+If comments are similar but one is more comprehensive, prefer the comprehensive one.
+If comments address different issues, keep them all.
+
+Return only the comment IDs (0, 1, 2, etc.) that should be kept, separated by commas (e.g., "0,2").
+Do not include any other text or explanation.
+
+File: {file_path}
+
+Comments:
+{comments_text}
+"""
+
+BATCH_DEDUP_TEMPLATE = """Given code review comments grouped by file, identify for each file which comments are unique and should be kept.
+If comments are similar but one is more comprehensive, prefer the comprehensive one.
+If comments address different issues, keep them all.
+Comment IDs are local to each file and start at 0.
+
+Return only a JSON object mapping each file path to the list of kept comment IDs,
+e.g. {{"file1.py": [0, 2], "file2.py": [0]}}. Do not include any other text or explanation.
+
+{files_block}
+"""
+
+
 class PreprocessingStage:
     def __init__(self, config, session_dir, preprocessor_llm):
         self.config = config
         self.session_dir = session_dir
         self.preprocessor_llm = preprocessor_llm
         self.parser = StrOutputParser()
+        # Build the chain once: template parsing is identical on every call
+        self._dedup_chain = PromptTemplate.from_template(DEDUP_TEMPLATE) | preprocessor_llm | self.parser
+        self._batch_dedup_chain = PromptTemplate.from_template(BATCH_DEDUP_TEMPLATE) | preprocessor_llm | self.parser
     
-    def run(self):
-        """Run the preprocessing stage to deduplicate comments"""
+    def run(self, output_queue=None):
+        """Run the preprocessing stage to deduplicate comments.
+
+        If output_queue is given, kept comments are also pushed onto it as
+        each file's group is resolved, so a downstream consumer can start
+        before the full deduplicated file is written.
+
+        Returns (output_file, deduplicated_comments).
+        """
         logger = get_logger()
         logger.processing("Starting preprocessing stage")
         
         preprocess_dir = self.session_dir / "preprocess"
         preprocess_dir.mkdir(exist_ok=True)
         
-        # Read input CSV
+        # Stream input CSV row by row — no need to materialize the full
+        # comment list before grouping
         input_file = Path(self.config['paths']['code_review_file'])
+        loaded = 0
         with open(input_file, 'r', encoding='utf-8') as f:
             reader = csv.DictReader(f)
-            comments = list(reader)
-        
-        # Add comment_id column (enumerate from 0)
-        for i, comment in enumerate(comments):
-            comment['comment_id'] = str(i)
-        
-        logger.info(f"Loaded {len(comments)} comments from {input_file}")
-        
-        # Deduplicate comments per file using LLM
-        deduplicated_comments = self._deduplicate_comments(comments)
+
+            def _rows():
+                nonlocal loaded
+                # Add comment_id column (enumerate from 0)
+                for i, comment in enumerate(reader):
+                    comment['comment_id'] = str(i)
+                    loaded += 1
+                    yield comment
+
+            # Deduplicate comments per file using LLM
+            deduplicated_comments = self._deduplicate_comments(_rows(), output_queue)
+
+        logger.info(f"Loaded {loaded} comments from {input_file}")
         
         # Save deduplicated file
         output_file = preprocess_dir / "code_review_deduplicated.csv"
@@ -48,15 +91,21 @@ class PreprocessingStage:
                 writer.writerows(deduplicated_comments)
         
         logger.stage_complete("preprocessing", {
-            "original_comments": len(comments),
+            "original_comments": loaded,
             "deduplicated_comments": len(deduplicated_comments)
         })
         logger.info(f"Deduplicated file saved to: {output_file}")
-        
-        return output_file
+
+        # Hand the parsed comments forward too — the expert stage can use
+        # them directly instead of re-parsing the CSV it just wrote
+        return output_file, deduplicated_comments
     
-    def _deduplicate_comments(self, comments):
-        """Deduplicate comments per file using LLM"""
+    def _deduplicate_comments(self, comments, output_queue=None):
+        """Deduplicate comments per file using LLM.
+
+        comments may be any iterable (including a generator); rows are
+        grouped by file while streaming.
+        """
         # Group comments by file_path
         files_comments = {}
         for comment in comments:
@@ -64,85 +113,165 @@ class PreprocessingStage:
             if file_path not in files_comments:
                 files_comments[file_path] = []
             files_comments[file_path].append(comment)
-        
+
         deduplicated = []
-        
-        for file_path, file_comments in files_comments.items():
+
+        def keep(items):
+            deduplicated.extend(items)
+            if output_queue is not None:
+                for item in items:
+                    output_queue.put(item)
+
+        # Collapse lexically-near-duplicate comments first — copy-pasted
+        # review comments are common and don't need an LLM to spot
+        clustered = {fp: self._lexical_cluster(fc) for fp, fc in files_comments.items()}
+
+        # One batched LLM call covers all multi-comment files; F round-trips
+        # collapse to 1. Single-comment files bypass the LLM entirely.
+        multi_files = {fp: fc for fp, fc in clustered.items() if len(fc) > 1}
+        batched_ids = self._deduplicate_files_batched(multi_files) if len(multi_files) > 1 else None
+
+        for file_path, file_comments in clustered.items():
             if len(file_comments) == 1:
                 # Only one comment for this file, keep it
-                deduplicated.extend(file_comments)
+                keep(file_comments)
                 print(f"  Single comment for {file_path}, keeping it")
                 continue
-            
-            print(f"  Deduplicating {len(file_comments)} comments for {file_path}")
-            
-            # Create local mapping for this file's comments
-            file_comment_mapping = {i: comment for i, comment in enumerate(file_comments)}
-            
-            # Use LLM to deduplicate comments for this file
-            comments_text = "\n".join([
-                f"Comment {i}: {comment['comment']}"
-                for i, comment in enumerate(file_comments)
-            ])
-            
-            prompt_template = """Given these code review comments for file {file_path}, identify which comments are unique and should be kept. 
-If comments are similar but one is more comprehensive, prefer the comprehensive one.
-If comments address different issues, keep them all.
 
-Comments:
-{comments_text}
+            if batched_ids is not None and file_path in batched_ids:
+                kept_local_ids = batched_ids[file_path]
+                print(f"  Deduplicated {len(file_comments)} -> {len(kept_local_ids)} comments for {file_path} (batched)")
+                keep([file_comments[i] for i in kept_local_ids])
+            else:
+                keep(self._deduplicate_file(file_path, file_comments))
 
-Return only the comment IDs (0, 1, 2, etc.) that should be kept, separated by commas (e.g., "0,2").
-Do not include any other text or explanation:"""
-            
-            try:
-                prompt = PromptTemplate(
-                    template=prompt_template,
-                    input_variables=["file_path", "comments_text"]
-                )
-                
-                chain = prompt | self.preprocessor_llm | self.parser
-                response = chain.invoke({
-                    "file_path": file_path,
-                    "comments_text": comments_text
-                })
-                
-                print(f"    LLM response: '{response.strip()}'")
-                
-                # Parse response to get local comment IDs
-                kept_local_ids = []
-                response_clean = response.strip()
-                
-                # Handle different response formats
-                if ',' in response_clean:
-                    id_parts = response_clean.split(',')
-                else:
-                    id_parts = response_clean.split()
-                
-                for id_str in id_parts:
-                    id_str = id_str.strip().replace('.', '').replace(':', '')
-                    if id_str.isdigit():
-                        local_id = int(id_str)
-                        if local_id < len(file_comments):
-                            kept_local_ids.append(local_id)
-                
-                if not kept_local_ids:
-                    print(f"    Warning: No valid IDs found in response, keeping all comments")
-                    kept_local_ids = list(range(len(file_comments)))
-                
-                print(f"    LLM selected {len(kept_local_ids)} unique comments: {kept_local_ids}")
-                
-                # Add selected comments to deduplicated list
-                for local_id in kept_local_ids:
-                    if local_id in file_comment_mapping:
-                        deduplicated.append(file_comment_mapping[local_id])
-                
-                print(f"    Deduplicated {len(file_comments)} -> {len(kept_local_ids)} comments for {file_path}")
-                        
-            except Exception as e:
-                print(f"    Error deduplicating comments for {file_path}: {e}")
-                print(f"    Falling back to keeping all {len(file_comments)} comments")
-                # Fallback: keep all comments for this file
-                deduplicated.extend(file_comments)
-        
-        return deduplicated
\ No newline at end of file
+        return deduplicated
+
+    @staticmethod
+    def _shingles(text):
+        """3-gram character shingles of normalized comment text"""
+        normalized = " ".join(text.lower().split())
+        if len(normalized) < 3:
+            return {normalized} if normalized else set()
+        return {normalized[i:i + 3] for i in range(len(normalized) - 2)}
+
+    def _lexical_cluster(self, file_comments):
+        """Collapse near-identical comments before any LLM call.
+
+        Comments whose 3-gram shingle sets have Jaccard similarity >= 0.85
+        are considered duplicates; the longest comment of each cluster is
+        kept as the most comprehensive one. Ambiguous pairs (lower
+        similarity) are left for the LLM to judge.
+        """
+        if len(file_comments) <= 1:
+            return file_comments
+
+        shingle_sets = [self._shingles(c['comment']) for c in file_comments]
+        representatives = []  # list of (comment, shingles)
+        for comment, shingles in zip(file_comments, shingle_sets):
+            for idx, (rep, rep_shingles) in enumerate(representatives):
+                union = len(shingles | rep_shingles)
+                if union and len(shingles & rep_shingles) / union >= 0.85:
+                    # Near-duplicate: keep the longer comment as representative
+                    if len(comment['comment']) > len(rep['comment']):
+                        representatives[idx] = (comment, shingles)
+                    break
+            else:
+                representatives.append((comment, shingles))
+
+        if len(representatives) < len(file_comments):
+            print(f"  Lexical pre-filter: {len(file_comments)} -> {len(representatives)} comments")
+        return [rep for rep, _ in representatives]
+
+    def _deduplicate_files_batched(self, multi_files):
+        """Deduplicate every multi-comment file with one LLM round-trip.
+
+        Returns file_path → kept local ids, or None if the response can't
+        be parsed (callers fall back to per-file calls).
+        """
+        if not multi_files:
+            return None
+
+        sections = []
+        for file_path, file_comments in multi_files.items():
+            body = "\n".join(f"Comment {i}: {comment['comment']}"
+                             for i, comment in enumerate(file_comments))
+            sections.append(f"## {file_path}\n{body}")
+
+        try:
+            response = self._batch_dedup_chain.invoke({"files_block": "\n\n".join(sections)})
+            text = response.strip()
+            # Tolerate markdown fences around the JSON object
+            obj_start, obj_end = text.find('{'), text.rfind('}')
+            if obj_start == -1 or obj_end == -1:
+                raise ValueError("No JSON object in batched response")
+            mapping = json.loads(text[obj_start:obj_end + 1])
+
+            result = {}
+            for file_path, file_comments in multi_files.items():
+                kept = mapping.get(file_path)
+                if not isinstance(kept, list):
+                    continue  # this file falls back to a per-file call
+                ids = sorted({int(i) for i in kept if str(i).lstrip('-').isdigit()
+                              and 0 <= int(i) < len(file_comments)})
+                if ids:
+                    result[file_path] = ids
+            return result or None
+        except Exception as e:
+            print(f"  Batched deduplication failed, falling back to per-file calls: {e}")
+            return None
+
+    def _deduplicate_file(self, file_path, file_comments):
+        """Deduplicate one file's comments with its own LLM call"""
+        print(f"  Deduplicating {len(file_comments)} comments for {file_path}")
+
+        # Create local mapping for this file's comments
+        file_comment_mapping = {i: comment for i, comment in enumerate(file_comments)}
+
+        # Use LLM to deduplicate comments for this file
+        comments_text = "\n".join([
+            f"Comment {i}: {comment['comment']}"
+            for i, comment in enumerate(file_comments)
+        ])
+
+        try:
+            response = self._dedup_chain.invoke({
+                "file_path": file_path,
+                "comments_text": comments_text
+            })
+
+            print(f"    LLM response: '{response.strip()}'")
+
+            # Parse response to get local comment IDs
+            kept_local_ids = []
+            response_clean = response.strip()
+
+            # Handle different response formats
+            if ',' in response_clean:
+                id_parts = response_clean.split(',')
+            else:
+                id_parts = response_clean.split()
+
+            for id_str in id_parts:
+                id_str = id_str.strip().replace('.', '').replace(':', '')
+                if id_str.isdigit():
+                    local_id = int(id_str)
+                    if local_id < len(file_comments):
+                        kept_local_ids.append(local_id)
+
+            if not kept_local_ids:
+                print(f"    Warning: No valid IDs found in response, keeping all comments")
+                kept_local_ids = list(range(len(file_comments)))
+
+            print(f"    LLM selected {len(kept_local_ids)} unique comments: {kept_local_ids}")
+            print(f"    Deduplicated {len(file_comments)} -> {len(kept_local_ids)} comments for {file_path}")
+
+            return [file_comment_mapping[local_id]
+                    for local_id in kept_local_ids
+                    if local_id in file_comment_mapping]
+
+        except Exception as e:
+            print(f"    Error deduplicating comments for {file_path}: {e}")
+            print(f"    Falling back to keeping all {len(file_comments)} comments")
+            # Fallback: keep all comments for this file
+            return file_comments
\ No newline at end of file
@@ -1,14 +1,28 @@
 import os
 import sys
 import time
+import asyncio
 import shutil
 import subprocess
 import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 from typing import Dict, Any, List, Optional
 from langchain.prompts import PromptTemplate
 from langchain_core.output_parsers import StrOutputParser
 
+from pytasksyn.utils.llm_stream import stream_until_fence
+from pytasksyn.utils.pytest_worker import PytestWorkerPool
+
+
+STUDENT_CODE_TEMPLATE = """{variation}
+
+Microcase:
+{microcase}
+
+Write complete, working Python code that solves this problem:"""
+
 
 class StudentStage:
     def __init__(self, config: Dict[str, Any], session_dir: Path, student_llm):
@@ -16,36 +30,66 @@ class StudentStage:
         self.session_dir = session_dir
         self.student_llm = student_llm
         self.parser = StrOutputParser()
+        # Build the chain once: template parsing is identical on every call
+        self._student_chain = PromptTemplate.from_template(STUDENT_CODE_TEMPLATE) | student_llm | self.parser
+        # Bounded pool of warm pytest workers shared by verifying threads
+        self._pytest_workers = PytestWorkerPool()
+        # Stage-wide executor for simulated students, created per run()
+        self._student_executor = None
     
     def run(self, expert_results: Dict[int, Dict], tutor_results: Optional[Dict[int, Dict]] = None) -> Dict[int, Dict]:
         """Run the student stage to test comprehension with simulated students"""
         print("Starting student stage...")
         
-        results = {}
         total_passed = 0
         total_evaluated = 0
-        
-        for comment_id, expert_result in expert_results.items():
-            if not expert_result['success']:
-                print(f"  Skipping comment {comment_id} (expert stage failed)")
-                continue
-            
-            # Check if tutor stage rejected this microcase
-            if tutor_results and comment_id in tutor_results:
-                if not tutor_results[comment_id]['accepted']:
-                    print(f"  Skipping comment {comment_id} (tutor stage rejected)")
+
+        # Run comprehension tests for independent comments concurrently
+        max_inflight = self.config.get('concurrency', {}).get('student', 4)
+        sem = asyncio.Semaphore(max_inflight)
+
+        # One stage-wide executor serves every comment's simulated students;
+        # a per-comment pool would spawn fresh threads (and pytest workers)
+        # for each comment. Sized for all in-flight comments at full fan-out.
+        max_parallel = self.config['student'].get('max_parallel',
+                                                  self.config['student']['num_students'])
+        self._student_executor = ThreadPoolExecutor(
+            max_workers=max(1, max_parallel) * max(1, max_inflight))
+
+        async def _run_one(comment_id, expert_result):
+            async with sem:
+                print(f"  Testing comprehension for comment {comment_id}")
+                return comment_id, await asyncio.to_thread(self._test_student_comprehension, comment_id, expert_result)
+
+        async def _run_all():
+            tasks = []
+            for comment_id, expert_result in expert_results.items():
+                if not expert_result['success']:
+                    print(f"  Skipping comment {comment_id} (expert stage failed)")
                     continue
-            
-            print(f"  Testing comprehension for comment {comment_id}")
-            result = self._test_student_comprehension(comment_id, expert_result)
-            results[comment_id] = result
-            
+
+                # Check if tutor stage rejected this microcase
+                if tutor_results and comment_id in tutor_results:
+                    if not tutor_results[comment_id]['accepted']:
+                        print(f"  Skipping comment {comment_id} (tutor stage rejected)")
+                        continue
+                tasks.append(_run_one(comment_id, expert_result))
+            return await asyncio.gather(*tasks)
+
+        try:
+            results = dict(asyncio.run(_run_all()))
+        finally:
+            self._student_executor.shutdown(wait=True)
+            self._student_executor = None
+            self._pytest_workers.close_all()
+
+        for comment_id, result in results.items():
             total_evaluated += 1
             if result['accepted']:
                 total_passed += 1
-                print(f"    ✓ Students passed (pass ratio: {result['pass_ratio']:.2f})")
+                print(f"    ✓ Students passed comment {comment_id} (pass ratio: {result['pass_ratio']:.2f})")
             else:
-                print(f"    ✗ Students failed (pass ratio: {result['pass_ratio']:.2f})")
+                print(f"    ✗ Students failed comment {comment_id} (pass ratio: {result['pass_ratio']:.2f})")
         
         print(f"Student stage completed: {total_passed}/{total_evaluated} microcases passed student validation")
         
@@ -67,9 +111,7 @@ class StudentStage:
         }
         
         # Load microcase description
-        microcase_file = expert_attempt_dir / "microcase.txt"
-        with open(microcase_file, 'r', encoding='utf-8') as f:
-            microcase = f.read()
+        microcase = (expert_attempt_dir / "microcase.txt").read_text(encoding='utf-8')
         
         # Create student output directory
         student_output_dir = comment_dir / "student_output"
@@ -81,28 +123,51 @@ class StudentStage:
         student_times = []
         
         print(f"    Generating solutions from {num_students} simulated students...")
-        
-        for student_id in range(num_students):
+
+        # Students are independent LLM calls — run them in parallel on the
+        # stage-wide executor (the GIL is released during the HTTP wait)
+        threshold = self.config['student']['comprehension_threshold']
+
+        # Stop early once the verdict is mathematically settled: enough
+        # passes to clear the threshold, or too many failures to ever reach it
+        stop = threading.Event()
+
+        def _run_student(student_id):
+            if stop.is_set():
+                return student_id, None, 0  # verdict already decided — skip
             start_time = time.time()
-            
             success = self._generate_student_solution(
                 microcase, student_id, student_output_dir, expert_attempt_dir
             )
-            
-            end_time = time.time()
-            duration = int(end_time - start_time)
+            return student_id, success, int(time.time() - start_time)
+
+        done = 0
+        futures = [self._student_executor.submit(_run_student, sid) for sid in range(num_students)]
+        for future in as_completed(futures):
+            student_id, success, duration = future.result()
+            if success is None:
+                continue
+            done += 1
             student_times.append(duration)
-            
             if success:
                 result['passed_students'].append(student_id)
             else:
                 result['failed_students'].append(student_id)
-        
+            passed = len(result['passed_students'])
+            decided_accept = passed / num_students >= threshold
+            decided_reject = (passed + num_students - done) / num_students < threshold
+            if (decided_accept or decided_reject) and not stop.is_set():
+                stop.set()
+                if done < num_students:
+                    print(f"    Verdict settled after {done}/{num_students} students, skipping the rest")
+
+        result['passed_students'].sort()
+        result['failed_students'].sort()
+
         # Calculate pass ratio
         result['pass_ratio'] = len(result['passed_students']) / num_students if num_students > 0 else 0.0
-        
+
         # Check if pass ratio meets threshold
-        threshold = self.config['student']['comprehension_threshold']
         result['accepted'] = result['pass_ratio'] >= threshold
         
         # Calculate duration stats
@@ -126,8 +191,7 @@ class StudentStage:
             
             # Save student solution
             solution_file = output_dir / f"student_{student_id}_solution.py"
-            with open(solution_file, 'w', encoding='utf-8') as f:
-                f.write(student_solution)
+            solution_file.write_text(student_solution, encoding='utf-8')
             
             # Test solution against expert test suite
             return self._test_student_solution(solution_file, expert_attempt_dir)
@@ -148,25 +212,13 @@ class StudentStage:
         ]
         
         variation = variations[student_id % len(variations)]
-        
-        prompt_template = """{variation}
+        inputs = {"variation": variation, "microcase": microcase}
 
-Microcase:
-{microcase}
+        # Stream and cut off runaway responses: past the closing code fence
+        # or the size cap there is nothing worth paying tokens for
+        max_chars = self.config['student'].get('max_response_chars', 20000)
+        response = stream_until_fence(self._student_chain, inputs, max_chars=max_chars)
 
-Write complete, working Python code that solves this problem:"""
-        
-        prompt = PromptTemplate(
-            template=prompt_template,
-            input_variables=["variation", "microcase"]
-        )
-        
-        chain = prompt | self.student_llm | self.parser
-        response = chain.invoke({
-            "variation": variation,
-            "microcase": microcase
-        })
-        
         return response.strip()
     
     def _test_student_solution(self, solution_file: Path, expert_attempt_dir: Path) -> bool:
@@ -177,16 +229,27 @@ Write complete, working Python code that solves this problem:"""
             if not solution_file.exists() or not expert_tests_dir.exists():
                 return False
 
-            # Expose student's module as solution_expert via PYTHONPATH
+            # Expose student's module as solution_expert via PYTHONPATH:
+            # symlink the student's file under the expected name — one
+            # syscall instead of read+write per verification (pytest only reads)
             env = os.environ.copy()
-            solution_dir = solution_file.parent
-            # Create a symlink-like import by adding the student's dir and setting module name via file copy name
-            # Instead of copying, rely on pytest's import by PYTHONPATH and the tests importing from solution_expert
-            # We'll create a temporary alias file in the same directory to match expected import
             with tempfile.TemporaryDirectory() as temp_dir:
                 temp_path = Path(temp_dir)
                 alias_path = temp_path / "solution_expert.py"
-                alias_path.write_text(solution_file.read_text(encoding='utf-8'), encoding='utf-8')
+                os.symlink(solution_file.resolve(), alias_path)
+
+                # Prefer the persistent worker — no interpreter startup per
+                # verify. The 30s guard against runaway student code is kept:
+                # on timeout the worker is retired and the run counts as failed
+                try:
+                    rc, _, _ = self._pytest_workers.run(
+                        expert_attempt_dir, "tests/", [temp_path], timeout=30)
+                    return rc == 0
+                except TimeoutError:
+                    print(f"      Student solution timed out during testing")
+                    return False
+                except Exception:
+                    pass  # worker died or never started; fall back to a one-shot run
 
                 env["PYTHONPATH"] = f"{str(temp_path)}{os.pathsep}{env.get('PYTHONPATH', '')}"
 
@@ -2,14 +2,50 @@ import os
 import json
 import sys
 import time
+import hashlib
+import threading
+import asyncio
 import shutil
 import subprocess
 import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import Dict, Any, Optional
 from langchain.prompts import PromptTemplate
 from langchain_core.output_parsers import StrOutputParser
 
+from pytasksyn.utils.llm_stream import stream_until_fence
+from pytasksyn.utils.pytest_worker import PytestWorkerPool
+
+
+TUTOR_SOLUTION_TEMPLATE = """As an educational tutor, solve this programming microcase to verify it's solvable and educational.
+
+Microcase:
+{microcase}
+
+Provide a complete, well-structured Python solution that demonstrates best practices.
+Focus on clarity and educational value:"""
+
+EDUCATIONAL_REVIEW_TEMPLATE = """As an educational tutor, evaluate this microcase for learning effectiveness.
+
+Microcase:
+{microcase}
+
+Rate this microcase on a scale of 0.0 to 1.0 based on how well it helps students learn from the original programming mistake.
+
+Consider these criteria:
+- Does it illustrate the general programming principle behind the mistake?
+- Does it clearly show why the original approach was problematic?
+- Is the microcase educational and appropriately challenging?
+- Is it focused and solvable within reasonable scope?
+- Does it provide good learning value for students?
+
+Respond with valid JSON containing exactly two keys:
+- 'score': a float between 0.0 and 1.0
+- 'review': a string explaining your reasoning for the score
+
+JSON Response:"""
+
 
 class TutorStage:
     def __init__(self, config: Dict[str, Any], session_dir: Path, tutor_llm):
@@ -17,28 +53,52 @@ class TutorStage:
         self.session_dir = session_dir
         self.tutor_llm = tutor_llm
         self.parser = StrOutputParser()
+        # Build chains once: template parsing is identical on every call
+        self._solution_chain = PromptTemplate.from_template(TUTOR_SOLUTION_TEMPLATE) | tutor_llm | self.parser
+        self._review_chain = PromptTemplate.from_template(EDUCATIONAL_REVIEW_TEMPLATE) | tutor_llm | self.parser
+        # Bounded pool of warm pytest workers shared by verifying threads
+        self._pytest_workers = PytestWorkerPool()
+        # The review depends only on the microcase text — memoize it so
+        # retry attempts don't pay for an identical LLM call
+        self._review_cache = {}
+        self._review_cache_lock = threading.Lock()
     
     def run(self, expert_results: Dict[int, Dict]) -> Dict[int, Dict]:
         """Run the tutor stage to validate microcases"""
         print("Starting tutor stage...")
         
-        results = {}
         successful_validations = 0
-        
-        for comment_id, expert_result in expert_results.items():
-            if not expert_result['success']:
-                print(f"  Skipping comment {comment_id} (expert stage failed)")
-                continue
-            
-            print(f"  Validating comment {comment_id}")
-            result = self._validate_microcase(comment_id, expert_result)
-            results[comment_id] = result
-            
+
+        # Validate comments concurrently — each validation is an
+        # independent LLM round-trip plus a pytest run
+        max_inflight = self.config.get('concurrency', {}).get('tutor', 4)
+        sem = asyncio.Semaphore(max_inflight)
+
+        async def _run_one(comment_id, expert_result):
+            async with sem:
+                print(f"  Validating comment {comment_id}")
+                return comment_id, await asyncio.to_thread(self._validate_microcase, comment_id, expert_result)
+
+        async def _run_all():
+            tasks = []
+            for comment_id, expert_result in expert_results.items():
+                if not expert_result['success']:
+                    print(f"  Skipping comment {comment_id} (expert stage failed)")
+                    continue
+                tasks.append(_run_one(comment_id, expert_result))
+            return await asyncio.gather(*tasks)
+
+        try:
+            results = dict(asyncio.run(_run_all()))
+        finally:
+            self._pytest_workers.close_all()
+
+        for comment_id, result in results.items():
             if result['accepted']:
                 successful_validations += 1
-                print(f"    ✓ Microcase accepted (score: {result['score']:.2f})")
+                print(f"    ✓ Microcase {comment_id} accepted (score: {result['score']:.2f})")
             else:
-                print(f"    ✗ Microcase rejected (score: {result['score']:.2f})")
+                print(f"    ✗ Microcase {comment_id} rejected (score: {result['score']:.2f})")
         
         total_validated = len([r for r in expert_results.values() if r['success']])
         print(f"Tutor stage completed: {successful_validations}/{total_validated} microcases accepted")
@@ -61,9 +121,7 @@ class TutorStage:
         }
         
         # Load microcase description
-        microcase_file = expert_attempt_dir / "microcase.txt"
-        with open(microcase_file, 'r', encoding='utf-8') as f:
-            microcase = f.read()
+        microcase = (expert_attempt_dir / "microcase.txt").read_text(encoding='utf-8')
         
         max_attempts = self.config['tutor']['max_solution_attempts']
         acceptance_threshold = self.config['tutor']['acceptance_threshold']
@@ -93,34 +151,39 @@ class TutorStage:
         
         return result
     
-    def _generate_tutor_validation(self, microcase: str, expert_attempt_dir: Path, 
+    def _generate_tutor_validation(self, microcase: str, expert_attempt_dir: Path,
                                  attempt_dir: Path, result: Dict) -> bool:
         """Generate tutor solution and review for one validation attempt"""
         try:
-            # Generate tutor solution
-            tutor_solution = self._generate_tutor_solution(microcase)
-            if not tutor_solution:
-                return False
-            
-            # Save tutor solution
-            solution_file = attempt_dir / "solution_tutor.py"
-            with open(solution_file, 'w', encoding='utf-8') as f:
-                f.write(tutor_solution)
-            
-            # Verify tutor solution passes expert tests
-            if not self._verify_tutor_solution(expert_attempt_dir, solution_file):
-                print(f"      Tutor solution failed expert tests")
-                return False
-            
-            # Generate educational review
-            review_data = self._generate_educational_review(microcase)
+            # The educational review depends only on the microcase, not on
+            # the solution — fire it concurrently with solution generation
+            # and verification instead of serializing the two LLM calls
+            with ThreadPoolExecutor(max_workers=1) as pool:
+                review_future = pool.submit(self._generate_educational_review, microcase)
+
+                # Generate tutor solution
+                tutor_solution = self._generate_tutor_solution(microcase)
+                if not tutor_solution:
+                    review_future.cancel()
+                    return False
+
+                # Save tutor solution
+                solution_file = attempt_dir / "solution_tutor.py"
+                solution_file.write_text(tutor_solution, encoding='utf-8')
+
+                # Verify tutor solution passes expert tests
+                if not self._verify_tutor_solution(expert_attempt_dir, solution_file):
+                    print(f"      Tutor solution failed expert tests")
+                    review_future.cancel()
+                    return False
+
+                review_data = review_future.result()
             if not review_data:
                 return False
             
             # Save review
             review_file = attempt_dir / "tutor_review.json"
-            with open(review_file, 'w', encoding='utf-8') as f:
-                json.dump(review_data, f, indent=2)
+            review_file.write_text(json.dumps(review_data, indent=2), encoding='utf-8')
             
             # Update result
             result['score'] = review_data['score']
@@ -134,22 +197,12 @@ class TutorStage:
     
     def _generate_tutor_solution(self, microcase: str) -> str:
         """Generate tutor's solution to verify microcase is solvable"""
-        prompt_template = """As an educational tutor, solve this programming microcase to verify it's solvable and educational.
+        # Stream and cut off runaway responses: past the closing code fence
+        # or the size cap there is nothing worth paying tokens for
+        max_chars = self.config['tutor'].get('max_response_chars', 20000)
+        response = stream_until_fence(self._solution_chain, {"microcase": microcase},
+                                      max_chars=max_chars)
 
-Microcase:
-{microcase}
-
-Provide a complete, well-structured Python solution that demonstrates best practices.
-Focus on clarity and educational value:"""
-        
-        prompt = PromptTemplate(
-            template=prompt_template,
-            input_variables=["microcase"]
-        )
-        
-        chain = prompt | self.tutor_llm | self.parser
-        response = chain.invoke({"microcase": microcase})
-        
         return response.strip()
     
     def _verify_tutor_solution(self, expert_attempt_dir: Path, tutor_solution_file: Path) -> bool:
@@ -159,11 +212,19 @@ Focus on clarity and educational value:"""
             if not tutor_solution_file.exists() or not expert_tests_dir.exists():
                 return False
 
-            # Make tutor solution available under expected name for tests
+            # Make tutor solution available under expected name for tests —
+            # a symlink avoids re-reading and re-writing the file (pytest only reads)
             with tempfile.TemporaryDirectory() as temp_dir:
                 temp_path = Path(temp_dir)
                 alias_path = temp_path / "solution_expert.py"
-                alias_path.write_text(tutor_solution_file.read_text(encoding='utf-8'), encoding='utf-8')
+                os.symlink(tutor_solution_file.resolve(), alias_path)
+
+                # Prefer the persistent worker — no interpreter startup per verify
+                try:
+                    rc, _, _ = self._pytest_workers.run(expert_attempt_dir, "tests/", [temp_path])
+                    return rc == 0
+                except Exception:
+                    pass  # worker died or never started; fall back to a one-shot run
 
                 env = os.environ.copy()
                 env["PYTHONPATH"] = f"{str(temp_path)}{os.pathsep}{env.get('PYTHONPATH', '')}"
@@ -179,34 +240,24 @@ Focus on clarity and educational value:"""
             return False
     
     def _generate_educational_review(self, microcase: str) -> Optional[Dict]:
-        """Generate educational review and scoring of the microcase"""
-        prompt_template = """As an educational tutor, evaluate this microcase for learning effectiveness.
+        """Generate educational review and scoring of the microcase.
 
-Microcase:
-{microcase}
-
-Rate this microcase on a scale of 0.0 to 1.0 based on how well it helps students learn from the original programming mistake.
-
-Consider these criteria:
-- Does it illustrate the general programming principle behind the mistake?
-- Does it clearly show why the original approach was problematic?
-- Is the microcase educational and appropriately challenging?
-- Is it focused and solvable within reasonable scope?
-- Does it provide good learning value for students?
+        Memoized per microcase hash: retries regenerate the solution but
+        the review input is unchanged, so later attempts reuse the verdict.
+        """
+        cache_key = hashlib.blake2b(microcase.encode('utf-8')).hexdigest()
+        with self._review_cache_lock:
+            if cache_key in self._review_cache:
+                return self._review_cache[cache_key]
 
-Respond with valid JSON containing exactly two keys:
-- 'score': a float between 0.0 and 1.0
-- 'review': a string explaining your reasoning for the score
+        review_data = self._generate_educational_review_uncached(microcase)
+        if review_data is not None:
+            with self._review_cache_lock:
+                self._review_cache[cache_key] = review_data
+        return review_data
 
-JSON Response:"""
-        
-        prompt = PromptTemplate(
-            template=prompt_template,
-            input_variables=["microcase"]
-        )
-        
-        chain = prompt | self.tutor_llm | self.parser
-        response = chain.invoke({"microcase": microcase})
+    def _generate_educational_review_uncached(self, microcase: str) -> Optional[Dict]:
+        response = self._review_chain.invoke({"microcase": microcase})
         
         try:
             # Try to parse as JSON
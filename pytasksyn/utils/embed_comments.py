@@ -106,43 +106,51 @@ def embed_comments_in_file(source_file: str, comments: List[Dict], output_file:
         f.writelines(output_lines)
 
 
-def main():
-    args = parse_args()
-    
-    review_file = Path(args.review_file)
-    project_root = Path(args.project_root)
-    output_dir = Path(args.output_dir)
-    
+def embed_comments_into_sources(review_file, project_root, output_dir) -> int:
+    """Embed all review comments into copies of their source files.
+
+    Callable in-process (no interpreter startup); returns 0 on success,
+    1 when inputs are missing.
+    """
+    review_file = Path(review_file)
+    project_root = Path(project_root)
+    output_dir = Path(output_dir)
+
     if not review_file.exists():
         print(f"Error: Review file not found: {review_file}")
         return 1
-    
+
     if not project_root.exists():
         print(f"Error: Project root not found: {project_root}")
         return 1
-    
+
     # Load review comments
     print(f"Loading comments from: {review_file}")
     comments_by_file = load_review_comments(str(review_file))
     print(f"Found comments for {len(comments_by_file)} files")
-    
+
     # Process each file with comments
     for file_path, comments in comments_by_file.items():
         print(f"Processing {file_path} ({len(comments)} comments)")
-        
+
         # Resolve full source file path
         source_file = project_root / file_path
-        
+
         # Create output file path (preserve directory structure)
         output_file = output_dir / file_path
-        
+
         # Embed comments
         embed_comments_in_file(str(source_file), comments, str(output_file))
         print(f"  -> Embedded file saved to: {output_file}")
-    
+
     print(f"\nAll embedded files saved to: {output_dir}")
     return 0
 
 
+def main():
+    args = parse_args()
+    return embed_comments_into_sources(args.review_file, args.project_root, args.output_dir)
+
+
 if __name__ == '__main__':
     exit(main())
\ No newline at end of file
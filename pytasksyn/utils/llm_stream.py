@@ -0,0 +1,34 @@
+"""Helper for streaming LLM responses with early cutoff."""
+
+
+def stream_until_fence(chain, inputs, max_chars=None):
+    """Stream a chain response and stop early when nothing useful remains.
+
+    Cuts the stream once the closing code fence arrives (the trailing
+    prose costs tokens and tail latency but never contains code) or, when
+    max_chars is set, once the response exceeds it. Falls back to a
+    one-shot invoke for providers without streaming support.
+
+    Fences split across chunks are counted exactly once: only trailing
+    backticks not already consumed by a counted fence are carried into
+    the next chunk (a run of k backticks yields k // 3 fences and k % 3
+    leftovers).
+    """
+    try:
+        parts = []
+        carry = ""
+        fence_count = 0
+        total = 0
+        for chunk in chain.stream(inputs):
+            parts.append(chunk)
+            total += len(chunk)
+            s = carry + chunk
+            fence_count += s.count('```')
+            trailing = len(s) - len(s.rstrip('`'))
+            carry = '`' * (trailing % 3)
+            if fence_count >= 2 or (max_chars is not None and total > max_chars):
+                break
+        return "".join(parts)
+    except Exception:
+        # Provider without streaming support — fall back to one-shot
+        return chain.invoke(inputs)
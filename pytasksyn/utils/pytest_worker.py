@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+"""
+Persistent pytest worker and its client classes.
+
+Run as a script, this process reads one JSON spec per line from stdin
+({"cwd", "tests", "pythonpath"}), runs pytest in-process and replies with
+one JSON line ({"rc", "out", "err"}). Keeping the interpreter and pytest
+imports warm amortizes the ~0.5-1 s of startup that `python -m pytest`
+pays on every verification.
+
+Imported as a module, it provides PytestWorker (one subprocess speaking
+the protocol above) and PytestWorkerPool (one worker per calling thread)
+for the pipeline stages; pytest itself is only imported inside the worker
+process.
+"""
+
+import contextlib
+import io
+import json
+import os
+import queue
+import select
+import subprocess
+import sys
+import threading
+from pathlib import Path
+
+
+class PytestWorker:
+    """Persistent pytest subprocess; amortizes interpreter+pytest startup"""
+
+    def __init__(self):
+        worker_script = Path(__file__)
+        self.proc = subprocess.Popen(
+            [sys.executable, '-u', str(worker_script)],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True
+        )
+
+    def run(self, cwd, tests, pythonpath, timeout=None):
+        spec = json.dumps({
+            'cwd': str(cwd),
+            'tests': str(tests),
+            'pythonpath': [str(p) for p in pythonpath]
+        })
+        self.proc.stdin.write(spec + '\n')
+        self.proc.stdin.flush()
+        if timeout is not None:
+            # Runaway test code would block readline forever — give up and
+            # retire this worker so the pool replaces it
+            ready, _, _ = select.select([self.proc.stdout], [], [], timeout)
+            if not ready:
+                self.close()
+                self.proc.wait()
+                raise TimeoutError(f"pytest worker timed out after {timeout}s")
+        line = self.proc.stdout.readline()
+        if not line:
+            raise RuntimeError("pytest worker exited unexpectedly")
+        result = json.loads(line)
+        return result['rc'], result['out'], result['err']
+
+    def close(self):
+        try:
+            self.proc.stdin.close()
+            self.proc.terminate()
+        except Exception:
+            pass
+
+
+class PytestWorkerPool:
+    """Bounded checkout pool of persistent pytest workers.
+
+    Verifying threads are often short-lived (per-attempt executors), so
+    workers are not tied to thread identity: run() checks an idle worker
+    out of a queue, uses it, and returns it, spawning new ones only up to
+    max_workers. That keeps the warm interpreters reused across threads
+    instead of leaking one per thread. Dead workers (crash or timeout)
+    are dropped and replaced transparently.
+    """
+
+    def __init__(self, max_workers=None):
+        self._max_workers = max_workers or (os.cpu_count() or 4)
+        self._idle = queue.Queue()
+        self._workers = []
+        self._lock = threading.Lock()
+
+    def _checkout(self) -> PytestWorker:
+        while True:
+            try:
+                worker = self._idle.get_nowait()
+            except queue.Empty:
+                with self._lock:
+                    if len(self._workers) < self._max_workers:
+                        worker = PytestWorker()
+                        self._workers.append(worker)
+                        return worker
+                # At capacity — wait for a worker (or a discard sentinel)
+                worker = self._idle.get()
+            if worker is None:
+                continue  # a discard freed capacity — retry the spawn path
+            if worker.proc.poll() is None:
+                return worker
+            # Worker died while idle — drop it and look again
+            self._discard(worker)
+
+    def _discard(self, worker: PytestWorker):
+        worker.close()
+        with self._lock:
+            try:
+                self._workers.remove(worker)
+            except ValueError:
+                return
+        # Wake one blocked waiter: capacity just freed, it can spawn anew
+        self._idle.put(None)
+
+    def run(self, cwd, tests, pythonpath, timeout=None):
+        worker = self._checkout()
+        try:
+            result = worker.run(cwd, tests, pythonpath, timeout=timeout)
+        except Exception:
+            # Broken worker (crash or timeout) must not go back in the queue
+            self._discard(worker)
+            raise
+        self._idle.put(worker)
+        return result
+
+    def close_all(self):
+        with self._lock:
+            workers, self._workers = self._workers, []
+        while True:
+            try:
+                self._idle.get_nowait()
+            except queue.Empty:
+                break
+        for worker in workers:
+            worker.close()
+
+
+def run_spec(spec):
+    """Run one pytest invocation described by spec, isolated from the next"""
+    import pytest
+
+    cwd = spec['cwd']
+    extra_paths = spec.get('pythonpath', [])
+    out_buf, err_buf = io.StringIO(), io.StringIO()
+    old_cwd = os.getcwd()
+    old_path = list(sys.path)
+    old_modules = set(sys.modules)
+    try:
+        os.chdir(cwd)
+        for p in reversed(extra_paths):
+            sys.path.insert(0, p)
+        with contextlib.redirect_stdout(out_buf), contextlib.redirect_stderr(err_buf):
+            rc = pytest.main(['-v', '--rootdir', cwd, '-p', 'no:cacheprovider', spec['tests']])
+    finally:
+        os.chdir(old_cwd)
+        sys.path[:] = old_path
+        # Drop modules imported by this run (solution and test modules) so
+        # the next spec re-imports fresh code instead of a cached module
+        for name in set(sys.modules) - old_modules:
+            del sys.modules[name]
+    return {'rc': int(rc), 'out': out_buf.getvalue(), 'err': err_buf.getvalue()}
+
+
+def main():
+    import pytest  # noqa: F401 — warm the import before the first spec arrives
+
+    for line in sys.stdin:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            result = run_spec(json.loads(line))
+        except Exception as e:
+            result = {'rc': 1, 'out': '', 'err': f'worker error: {e}'}
+        sys.stdout.write(json.dumps(result) + '\n')
+        sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()